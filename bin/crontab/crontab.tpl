@@ -9,8 +9,13 @@ HOME=/tmp
 # Every minute!
 * * * * * {{ cron }}
 
+* * * * * {{ django }} queue_depth
+* * * * * {{ django }} deliver_notices
+* * * * * {{ django }} forward_bango_events
+
 # Every hour.
 42 * * * * {{ django }} cleanup
+17 * * * * {{ django }} clean_task_args
 
 # Every 2 hours.
 1 */2 * * * {{ cron }} something
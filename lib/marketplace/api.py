@@ -1,7 +1,21 @@
+import logging
+import time
+
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 
-from ..utils import SlumberWrapper
+from requests.exceptions import RequestException
+from slumber.exceptions import HttpServerError
+
+from ..utils import LocalCache, SlumberWrapper
+
+log = logging.getLogger('w.marketplace')
+
+# The whole price tier table is stored under this key along with the
+# time it should be refreshed at.
+PRICE_TABLE_KEY = 'marketplace:prices:bango'
+PRICE_TABLE_LOCK = PRICE_TABLE_KEY + ':lock'
 
 
 class UnknownPricePoint(Exception):
@@ -10,15 +24,131 @@ class UnknownPricePoint(Exception):
 
 class MarketplaceAPI(SlumberWrapper):
     errors = {}
+    service = 'marketplace'
+
+    def __init__(self, *args, **kw):
+        super(MarketplaceAPI, self).__init__(*args, **kw)
+        self.prices = LocalCache(size=settings.PRICE_CACHE_LOCAL_SIZE,
+                                 timeout=settings.PRICE_CACHE_LOCAL_TIMEOUT)
 
     def get_price(self, point):
-        # TODO: cache this.
+        """
+        Returns the price tier for a price point.
+
+        Tiers are served from a process-local cache, then from the price
+        tier table in the Django cache. Price points missing from the
+        table are looked up directly.
+
+        :param point: the price point, as found in a pay request.
+        :rtype: dictionary
+        """
+        if not settings.PRICE_CACHE_TIMEOUT:
+            return self._get_price(point)
+
+        point = str(point)
+        price = self.prices.get(point)
+        if price is None:
+            price = self.get_price_table().get(point)
+            if price is None:
+                # This tier might have been added since the table was
+                # loaded.
+                price = self._get_price(point)
+            self.prices.set(point, price)
+        return price
+
+    def _get_price(self, point):
         try:
             return (self.api.webpay.prices()
                     .get_object(provider='bango', pricePoint=point))
         except ObjectDoesNotExist:
             raise UnknownPricePoint(point)
 
+    def get_price_table(self):
+        """
+        Returns all price tiers keyed by price point.
+
+        When the cached table is older than PRICE_CACHE_TIMEOUT one
+        caller queues the refresh_prices task and everyone keeps using
+        the old copy until it is done. If Marketplace cannot be reached
+        the old copy is served for up to PRICE_CACHE_STALE_TIMEOUT
+        seconds. When nothing is cached one caller loads the table while
+        the others wait for it, for up to PRICE_CACHE_LOCK_TIMEOUT
+        seconds.
+        """
+        entry = cache.get(PRICE_TABLE_KEY)
+        if entry is None:
+            return self._load_missing_prices()
+
+        if (entry['refresh_at'] <= time.time() and
+            cache.add(PRICE_TABLE_LOCK, True,
+                      settings.PRICE_CACHE_LOCK_TIMEOUT)):
+            # Imported here because the tasks use this client.
+            from webpay.pay.tasks import refresh_prices
+            try:
+                refresh_prices.delay()
+            except Exception:
+                log.exception('Could not queue a price tier refresh')
+                cache.delete(PRICE_TABLE_LOCK)
+        return entry['prices']
+
+    def _load_missing_prices(self):
+        # The lock expires on its own in case its holder died. If it still
+        # can't be taken by then, such as when the cache is down, the table
+        # is loaded without it.
+        deadline = time.time() + settings.PRICE_CACHE_LOCK_TIMEOUT
+        while not cache.add(PRICE_TABLE_LOCK, True,
+                            settings.PRICE_CACHE_LOCK_TIMEOUT):
+            entry = cache.get(PRICE_TABLE_KEY)
+            if entry is not None:
+                return entry['prices']
+            if time.time() >= deadline:
+                log.warning('Gave up waiting for the price tier lock')
+                return self.load_prices()
+            time.sleep(0.25)
+        try:
+            # It might have been loaded while waiting for the lock.
+            entry = cache.get(PRICE_TABLE_KEY)
+            if entry is not None:
+                return entry['prices']
+            return self.load_prices()
+        finally:
+            cache.delete(PRICE_TABLE_LOCK)
+
+    def refresh_prices(self):
+        """
+        Reloads the price tier table for the refresh_prices task and
+        releases the lock taken when it was queued.
+        """
+        try:
+            self.load_prices()
+        except (HttpServerError, RequestException):
+            entry = cache.get(PRICE_TABLE_KEY) or {}
+            log.exception('Could not refresh price tiers, serving '
+                          'tiers loaded at %s' % entry.get('loaded_at'))
+        finally:
+            cache.delete(PRICE_TABLE_LOCK)
+
+    def load_prices(self):
+        """
+        Fetches the whole price tier table from Marketplace and caches it.
+
+        This is called when workers start so that the first purchases
+        don't have to wait for it.
+        """
+        res = self.api.webpay.prices.get(provider='bango', limit=0)
+        table = dict((str(p['pricePoint']), p) for p in res['objects'])
+        now = time.time()
+        cache.set(PRICE_TABLE_KEY,
+                  {'prices': table,
+                   'loaded_at': now,
+                   'refresh_at': now + settings.PRICE_CACHE_TIMEOUT},
+                  settings.PRICE_CACHE_STALE_TIMEOUT)
+        for point, price in table.iteritems():
+            self.prices.set(point, price)
+        log.info('Loaded %s price tiers' % len(table))
+        return table
+
+
 if not settings.MARKETPLACE_URL:
     raise ValueError('MARKETPLACE_URL is required')
 
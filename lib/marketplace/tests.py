@@ -3,8 +3,10 @@ from django.test import TestCase
 
 import mock
 from nose.tools import eq_, raises
+from slumber.exceptions import HttpServerError
 
-from lib.marketplace.api import client, UnknownPricePoint
+from lib.marketplace.api import client, PRICE_TABLE_LOCK, UnknownPricePoint
+from webpay.base.tests import local_cache
 
 
 sample_price = {
@@ -30,3 +32,85 @@ class SolitudeAPITest(TestCase):
     def test_invalid_price_point(self, slumber):
         slumber.webpay.prices.side_effect = ObjectDoesNotExist
         client.get_price(1)
+
+
+@mock.patch('lib.marketplace.api.client.api')
+class PriceCacheTest(TestCase):
+
+    def setUp(self):
+        p = local_cache('lib.marketplace.api.cache')
+        self.cache = p.start()
+        self.addCleanup(p.stop)
+        client.prices.clear()
+        self.addCleanup(client.prices.clear)
+
+    def set_table(self, slumber, *prices):
+        slumber.webpay.prices.get.return_value = {'objects': list(prices)}
+
+    def test_table_loaded_once(self, slumber):
+        self.set_table(slumber, sample_price)
+        with self.settings(PRICE_CACHE_TIMEOUT=60):
+            eq_(client.get_price(0)['name'], sample_price['name'])
+            client.prices.clear()
+            eq_(client.get_price('0')['name'], sample_price['name'])
+        eq_(slumber.webpay.prices.get.call_count, 1)
+        assert not slumber.webpay.prices.called
+
+    def test_missing_from_table(self, slumber):
+        self.set_table(slumber, sample_price)
+        sample = mock.Mock()
+        sample.get_object.return_value = dict(sample_price, pricePoint='1')
+        slumber.webpay.prices.return_value = sample
+        with self.settings(PRICE_CACHE_TIMEOUT=60):
+            eq_(client.get_price(1)['pricePoint'], '1')
+        sample.get_object.assert_called_with(provider='bango', pricePoint='1')
+
+    @raises(UnknownPricePoint)
+    def test_unknown_with_table(self, slumber):
+        self.set_table(slumber, sample_price)
+        slumber.webpay.prices.side_effect = ObjectDoesNotExist
+        with self.settings(PRICE_CACHE_TIMEOUT=60):
+            client.get_price(1)
+
+    @mock.patch('webpay.pay.tasks.refresh_prices.delay')
+    def test_refresh_queued(self, delay, slumber):
+        self.set_table(slumber, sample_price)
+        with self.settings(PRICE_CACHE_TIMEOUT=-1):
+            client.load_prices()
+            client.prices.clear()
+            eq_(client.get_price(0)['name'], sample_price['name'])
+            client.prices.clear()
+            client.get_price(0)
+        # The stale table is served and only one refresh is queued.
+        eq_(delay.call_count, 1)
+        eq_(slumber.webpay.prices.get.call_count, 1)
+
+    def test_serve_stale(self, slumber):
+        self.set_table(slumber, sample_price)
+        with self.settings(PRICE_CACHE_TIMEOUT=-1):
+            client.load_prices()
+            client.prices.clear()
+            slumber.webpay.prices.get.side_effect = HttpServerError
+            # CELERY_ALWAYS_EAGER runs the refresh here, which fails.
+            eq_(client.get_price(0)['name'], sample_price['name'])
+        assert self.cache.add(PRICE_TABLE_LOCK, True)
+
+    @mock.patch('lib.marketplace.api.time.sleep')
+    def test_wait_for_missing_table(self, sleep, slumber):
+        self.set_table(slumber, sample_price)
+        self.cache.add(PRICE_TABLE_LOCK, True)
+        # Another process loads the table while this one waits.
+        sleep.side_effect = lambda s: client.load_prices()
+        with self.settings(PRICE_CACHE_TIMEOUT=60):
+            eq_(client.get_price(0)['name'], sample_price['name'])
+        eq_(slumber.webpay.prices.get.call_count, 1)
+
+    @mock.patch('lib.marketplace.api.time.sleep')
+    def test_give_up_waiting(self, sleep, slumber):
+        self.set_table(slumber, sample_price)
+        # Like a cache that is down, the lock can never be taken.
+        self.cache.add = mock.Mock(return_value=False)
+        with self.settings(PRICE_CACHE_TIMEOUT=60,
+                           PRICE_CACHE_LOCK_TIMEOUT=0):
+            eq_(client.get_price(0)['name'], sample_price['name'])
+        eq_(slumber.webpay.prices.get.call_count, 1)
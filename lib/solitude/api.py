@@ -1,12 +1,22 @@
+import functools
+import hashlib
 import json
 import logging
+import threading
+import time
 import uuid
 import warnings
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.encoding import smart_str
 
-from ..utils import SlumberWrapper
+from requests.exceptions import RequestException
+from slumber.exceptions import HttpServerError
+
+from ..utils import (AsyncWrapper, BloomFilter, LocalCache, run_parallel,
+                     SlumberWrapper)
 from .constants import ACCESS_PURCHASE
 from .errors import ERROR_STRINGS
 from webpay.pay.models import Issuer
@@ -14,6 +24,38 @@ from webpay.pay.models import Issuer
 
 log = logging.getLogger('w.solitude')
 client = None
+_local = threading.local()
+
+# Cached in place of an issuer that has no active product.
+UNKNOWN_ISSUER = 'unknown'
+# A filter of every issuer with an active product.
+ISSUER_FILTER_KEY = 'solitude:issuers:filter'
+ISSUER_FILTER_LOCK = ISSUER_FILTER_KEY + ':lock'
+# Changed by forget_issuer() so that every process drops what it knows
+# about issuers.
+ISSUER_VERSION_KEY = 'solitude:issuers:version'
+
+
+def start_buyer_cache(buyer_ids=None):
+    """
+    Remember buyers fetched from solitude until end_buyer_cache() is called.
+
+    This is meant to be scoped to a single request so that each buyer is
+    only fetched once.
+
+    :param buyer_ids: dictionary of known buyer uuid to resource_pk. It is
+                      updated as buyers are fetched so it can be kept
+                      around between requests.
+    """
+    _local.buyers = {}
+    _local.buyer_ids = buyer_ids if buyer_ids is not None else {}
+
+
+def end_buyer_cache():
+    """Stop remembering buyers and return the known buyer ids."""
+    buyer_ids = getattr(_local, 'buyer_ids', None)
+    _local.buyers = _local.buyer_ids = None
+    return buyer_ids
 
 
 class SellerNotConfigured(Exception):
@@ -26,6 +68,17 @@ class SolitudeAPI(SlumberWrapper):
     :param url: URL of the solitude endpoint.
     """
     errors = ERROR_STRINGS
+    service = 'solitude'
+
+    def __init__(self, *args, **kw):
+        super(SolitudeAPI, self).__init__(*args, **kw)
+        # Issuers recently found to be unknown, checked before any I/O.
+        self.unknown_issuers = LocalCache(
+            size=settings.ISSUER_UNKNOWN_LOCAL_SIZE,
+            timeout=settings.ISSUER_CACHE_UNKNOWN_TIMEOUT)
+        self._issuer_filter = None
+        self._issuer_filter_at = 0
+        self._issuer_version = None
 
     def _buyer_from_response(self, res):
         buyer = {}
@@ -61,7 +114,9 @@ class SolitudeAPI(SlumberWrapper):
 
         res = self.safe_run(self.slumber.generic.buyer.post, {'uuid': uuid,
                                                               'pin': pin})
-        return self._buyer_from_response(res)
+        buyer = self._buyer_from_response(res)
+        self._remember_buyer(uuid, buyer)
+        return buyer
 
     def set_needs_pin_reset(self, uuid, value=True):
         """Set flag for user to go through reset flow or not on next log in.
@@ -71,10 +126,11 @@ class SolitudeAPI(SlumberWrapper):
                       not, defaults to True
         :rtype: dictionary
         """
-        buyer = self.get_buyer(uuid)
-        res = self.safe_run(self.slumber.generic.buyer(id=buyer['id']).patch,
+        buyer_id = self._get_buyer_id(uuid)
+        res = self.safe_run(self.slumber.generic.buyer(id=buyer_id).patch,
                             {'needs_pin_reset': value,
                              'new_pin': None})
+        self._forget_buyer(uuid)
         if 'errors' in res:
             return res
         return {}
@@ -88,9 +144,10 @@ class SolitudeAPI(SlumberWrapper):
         :param pin: PIN the user would like to change to.
         :rtype: dictionary
         """
-        buyer = self.get_buyer(uuid)
-        res = self.safe_run(self.slumber.generic.buyer(id=buyer['id']).patch,
+        buyer_id = self._get_buyer_id(uuid)
+        res = self.safe_run(self.slumber.generic.buyer(id=buyer_id).patch,
                             {'pin': pin})
+        self._forget_buyer(uuid)
         # Empty string is a good thing from tastypie for a PATCH.
         if 'errors' in res:
             return res
@@ -104,9 +161,10 @@ class SolitudeAPI(SlumberWrapper):
         :param pin: PIN the user would like to change to.
         :rtype: dictionary
         """
-        buyer = self.get_buyer(uuid)
-        res = self.safe_run(self.slumber.generic.buyer(id=buyer['id']).patch,
+        buyer_id = self._get_buyer_id(uuid)
+        res = self.safe_run(self.slumber.generic.buyer(id=buyer_id).patch,
                             {'new_pin': new_pin})
+        self._forget_buyer(uuid)
         # Empty string is a good thing from tastypie for a PATCH.
         if 'errors' in res:
             return res
@@ -115,12 +173,39 @@ class SolitudeAPI(SlumberWrapper):
     def get_buyer(self, uuid):
         """Retrieves a buyer by the their uuid.
 
+        Within start_buyer_cache() and end_buyer_cache() the buyer is only
+        fetched once until it is changed.
+
         :param uuid: String to identify the buyer by.
         :rtype: dictionary
         """
+        buyers = getattr(_local, 'buyers', None)
+        if buyers is not None and uuid in buyers:
+            return buyers[uuid]
 
         res = self.safe_run(self.slumber.generic.buyer.get, uuid=uuid)
-        return self._buyer_from_response(res)
+        buyer = self._buyer_from_response(res)
+        self._remember_buyer(uuid, buyer)
+        return buyer
+
+    def _get_buyer_id(self, uuid):
+        buyer_ids = getattr(_local, 'buyer_ids', None)
+        if buyer_ids and uuid in buyer_ids:
+            return buyer_ids[uuid]
+        return self.get_buyer(uuid)['id']
+
+    def _remember_buyer(self, uuid, buyer):
+        if getattr(_local, 'buyers', None) is None or buyer.get('errors'):
+            return
+        _local.buyers[uuid] = buyer
+        if buyer.get('id'):
+            _local.buyer_ids[uuid] = buyer['id']
+
+    def _forget_buyer(self, uuid):
+        """The buyer was changed in solitude so fetch it again next time."""
+        buyers = getattr(_local, 'buyers', None)
+        if buyers is not None:
+            buyers.pop(uuid, None)
 
     def get_active_product(self, public_id):
         """
@@ -132,6 +217,132 @@ class SolitudeAPI(SlumberWrapper):
         return self.slumber.generic.product.get_object(
             seller__active=True, public_id=public_id)
 
+    def get_issuer(self, public_id):
+        """
+        Returns the secret, access and seller URI of an active product.
+
+        Issuers are cached for ISSUER_CACHE_TIMEOUT seconds. Issuers
+        without an active product are cached for
+        ISSUER_CACHE_UNKNOWN_TIMEOUT seconds, and are usually rejected
+        by the filter of known issuers before anything is looked up.
+
+        :param public_id: Product public_id, the iss of a JWT.
+        :rtype: dictionary
+        :raises ObjectDoesNotExist: there is no active product.
+        """
+        self._check_issuer_version()
+        if (self.unknown_issuers.get(public_id) or
+            not self.may_be_issuer(public_id)):
+            raise ObjectDoesNotExist('No active product for %r' % public_id)
+
+        key = self._issuer_key(public_id)
+        issuer = cache.get(key)
+        if issuer is None:
+            try:
+                product = self.get_active_product(public_id)
+            except ObjectDoesNotExist:
+                cache.set(key, UNKNOWN_ISSUER,
+                          settings.ISSUER_CACHE_UNKNOWN_TIMEOUT)
+                self.unknown_issuers.set(public_id, True)
+                raise
+            issuer = {'secret': product['secret'],
+                      'access': product['access'],
+                      'seller': product['seller']}
+            cache.set(key, issuer, settings.ISSUER_CACHE_TIMEOUT)
+        if issuer == UNKNOWN_ISSUER:
+            self.unknown_issuers.set(public_id, True)
+            raise ObjectDoesNotExist('No active product for %r' % public_id)
+        return issuer
+
+    def forget_issuer(self, public_id):
+        """
+        Removes an issuer from the cache, such as when its secret changes.
+
+        Its seller is removed too in case the product moved to another
+        one. The filter of known issuers is rebuilt in case it is new.
+        Every process drops its own copy of the filter and of unknown
+        issuers on its next lookup.
+        """
+        seller_key = self._seller_key('issuer', public_id)
+        seller = cache.get(seller_key)
+        if seller is not None:
+            cache.delete(self._seller_key('uuid', seller['uuid']))
+        cache.delete(seller_key)
+        cache.delete(self._issuer_key(public_id))
+        cache.delete(ISSUER_FILTER_KEY)
+        cache.set(ISSUER_VERSION_KEY, uuid.uuid4().hex,
+                  settings.ISSUER_CACHE_TIMEOUT)
+
+    def _check_issuer_version(self):
+        version = cache.get(ISSUER_VERSION_KEY)
+        if version != self._issuer_version:
+            self._issuer_version = version
+            self._issuer_filter_at = 0
+            self.unknown_issuers.clear()
+
+    def may_be_issuer(self, public_id):
+        """
+        Returns False if public_id is certainly not an active product.
+
+        This is True for every issuer when the filter is turned off with
+        ISSUER_FILTER_REFRESH or can't be loaded.
+        """
+        if not settings.ISSUER_FILTER_REFRESH:
+            return True
+        issuers = self.get_issuer_filter()
+        return issuers is None or public_id in issuers
+
+    def get_issuer_filter(self):
+        """
+        Returns a BloomFilter of the public_id of every active product.
+
+        Each process keeps its copy for ISSUER_FILTER_REFRESH seconds, or
+        until forget_issuer() is called, before getting it from the Django
+        cache again. When the cached copy is older than that too, or was
+        built before forget_issuer() was last called, one caller rebuilds
+        it from Solitude.
+        """
+        now = time.time()
+        if now - self._issuer_filter_at < settings.ISSUER_FILTER_REFRESH:
+            return self._issuer_filter
+        self._issuer_filter_at = now
+
+        entry = cache.get(ISSUER_FILTER_KEY)
+        if ((entry is None or
+             entry['loaded_at'] + settings.ISSUER_FILTER_REFRESH <= now or
+             entry.get('version') != self._issuer_version) and
+            cache.add(ISSUER_FILTER_LOCK, True, 60)):
+            try:
+                entry = self.load_issuer_filter()
+            except (HttpServerError, RequestException):
+                log.exception('Could not load the issuer filter')
+            finally:
+                cache.delete(ISSUER_FILTER_LOCK)
+        self._issuer_filter = entry['issuers'] if entry else None
+        return self._issuer_filter
+
+    def load_issuer_filter(self):
+        """Builds the filter of known issuers and caches it."""
+        res = self.slumber.generic.product.get(seller__active=True, limit=0)
+        issuers = BloomFilter(len(res['objects']),
+                              settings.ISSUER_FILTER_ERROR_RATE)
+        for product in res['objects']:
+            issuers.add(product['public_id'])
+        entry = {'issuers': issuers, 'loaded_at': time.time(),
+                 'version': self._issuer_version}
+        # A filter that can't be refreshed for a while is dropped so that
+        # new issuers aren't turned away for long.
+        cache.set(ISSUER_FILTER_KEY, entry,
+                  settings.ISSUER_FILTER_REFRESH * 3)
+        log.info('Loaded a filter of %s issuers' % len(res['objects']))
+        return entry
+
+    def _issuer_key(self, public_id):
+        # Issuers come from JWTs so they could be anything; hash them to
+        # get a valid cache key.
+        return 'solitude:issuer:%s' % hashlib.md5(
+            smart_str(public_id)).hexdigest()
+
     def confirm_pin(self, uuid, pin):
         """Confirms the buyer's pin, marking it at confirmed in solitude
 
@@ -142,6 +353,7 @@ class SolitudeAPI(SlumberWrapper):
 
         res = self.safe_run(self.slumber.generic.confirm_pin.post,
                             {'uuid': uuid, 'pin': pin})
+        self._forget_buyer(uuid)
         return res.get('confirmed', False)
 
     def reset_confirm_pin(self, uuid, pin):
@@ -154,6 +366,7 @@ class SolitudeAPI(SlumberWrapper):
 
         res = self.safe_run(self.slumber.generic.reset_confirm_pin.post,
                             {'uuid': uuid, 'pin': pin})
+        self._forget_buyer(uuid)
         return res.get('confirmed', False)
 
     def verify_pin(self, uuid, pin):
@@ -166,6 +379,8 @@ class SolitudeAPI(SlumberWrapper):
 
         res = self.safe_run(self.slumber.generic.verify_pin.post,
                             {'uuid': uuid, 'pin': pin})
+        # Failed attempts can lock the buyer out.
+        self._forget_buyer(uuid)
         return res
 
     def configure_product_for_billing(self, transaction_uuid,
@@ -174,27 +389,24 @@ class SolitudeAPI(SlumberWrapper):
                                       redirect_url_onsuccess,
                                       redirect_url_onerror,
                                       prices, icon_url,
-                                      user_uuid):
+                                      user_uuid, seller=None,
+                                      bango_product_uri=None):
         """
         Get the billing configuration ID for a Bango transaction.
+
+        Pass the seller record as seller and the result of
+        get_bango_product() as bango_product_uri if they were already
+        fetched.
         """
-        try:
-            seller = self.slumber.generic.seller.get_object(uuid=seller_uuid)
-        except ObjectDoesNotExist:
-            raise SellerNotConfigured('Seller with uuid %s does not exist'
-                                      % seller_uuid)
+        if seller is None:
+            seller = self.get_seller(seller_uuid)
         seller_id = seller['resource_pk']
         log.info('transaction %s: seller: %s' % (transaction_uuid,
                                                  seller_id))
 
-        try:
-            bango_product_uri = self.slumber.bango.product.get_object(
-                    seller_product__seller=seller_id,
-                    seller_product__external_id=product_id)['resource_uri']
-        except ObjectDoesNotExist:
-            bango_product_uri = self.create_product(product_id,
-                    product_name, seller)
-
+        if bango_product_uri is None:
+            bango_product_uri = self.get_bango_product(seller, product_id,
+                                                       product_name)
         log.info('transaction %s: bango product: %s'
                  % (transaction_uuid, bango_product_uri))
 
@@ -215,6 +427,110 @@ class SolitudeAPI(SlumberWrapper):
 
         return bill_id, seller_id
 
+    def get_seller(self, seller_uuid):
+        """
+        Retrieves a seller, including its bango account, by its uuid.
+
+        Sellers are cached for SELLER_CACHE_TIMEOUT seconds.
+
+        :param seller_uuid: String to identify the seller by.
+        :rtype: dictionary
+        """
+        key = self._seller_key('uuid', seller_uuid)
+        seller = cache.get(key)
+        if seller is None:
+            try:
+                seller = self.slumber.generic.seller.get_object(
+                    uuid=seller_uuid)
+            except ObjectDoesNotExist:
+                raise SellerNotConfigured('Seller with uuid %s does not exist'
+                                          % seller_uuid)
+            cache.set(key, seller, settings.SELLER_CACHE_TIMEOUT)
+        return seller
+
+    def get_issuer_seller(self, issuer_key):
+        """
+        Retrieves the seller, including its bango account, of the product
+        that issued a JWT.
+
+        The product comes from get_issuer() and sellers are cached for
+        SELLER_CACHE_TIMEOUT seconds.
+
+        :param issuer_key: Product public_id, the iss of a JWT.
+        :rtype: dictionary
+        :raises ObjectDoesNotExist: there is no active product.
+        """
+        key = self._seller_key('issuer', issuer_key)
+        seller = cache.get(key)
+        if seller is None:
+            seller_uri = self.get_issuer(issuer_key)['seller']
+            seller = (self.slumber.generic
+                          .seller(seller_uri.split('/')[-2])
+                          .get_object_or_404())
+            cache.set(key, seller, settings.SELLER_CACHE_TIMEOUT)
+            cache.set(self._seller_key('uuid', seller['uuid']), seller,
+                      settings.SELLER_CACHE_TIMEOUT)
+        return seller
+
+    def _seller_key(self, kind, value):
+        return 'solitude:seller:%s:%s' % (
+            kind, hashlib.md5(smart_str(value)).hexdigest())
+
+    def get_bango_product(self, seller, product_id, product_name):
+        """
+        Returns the URI of the seller's bango product, creating it if needed.
+
+        URIs are cached for BANGO_PRODUCT_CACHE_TIMEOUT seconds. When the
+        product doesn't exist yet only one caller creates it while any
+        others wait for the result.
+        """
+        key = self._seller_key('bango-product:%s' % seller['resource_pk'],
+                               product_id)
+        uri = cache.get(key)
+        if uri is None:
+            uri = self._find_bango_product(seller, product_id)
+            if uri is None:
+                return self._create_bango_product(key, seller, product_id,
+                                                  product_name)
+            cache.set(key, uri, settings.BANGO_PRODUCT_CACHE_TIMEOUT)
+        return uri
+
+    def _find_bango_product(self, seller, product_id):
+        try:
+            return self.slumber.bango.product.get_object(
+                    seller_product__seller=seller['resource_pk'],
+                    seller_product__external_id=product_id)['resource_uri']
+        except ObjectDoesNotExist:
+            return None
+
+    def _create_bango_product(self, key, seller, product_id, product_name):
+        lock = key + ':lock'
+        timeout = settings.BANGO_PRODUCT_LOCK_TIMEOUT
+        # The lock expires on its own in case its holder died. If it still
+        # can't be taken by then, such as when the cache is down, the
+        # product is looked up or created without it.
+        deadline = time.time() + timeout
+        locked = cache.add(lock, True, timeout)
+        while not locked:
+            uri = cache.get(key)
+            if uri is not None:
+                return uri
+            if time.time() >= deadline:
+                log.warning('Gave up waiting for the bango product lock '
+                            '%s' % lock)
+                break
+            time.sleep(0.25)
+            locked = cache.add(lock, True, timeout)
+        try:
+            # It might have been created while waiting for the lock.
+            uri = (self._find_bango_product(seller, product_id) or
+                   self.create_product(product_id, product_name, seller))
+            cache.set(key, uri, settings.BANGO_PRODUCT_CACHE_TIMEOUT)
+            return uri
+        finally:
+            if locked:
+                cache.delete(lock)
+
     def create_product(self, external_id, product_name, seller):
         """
         Creates a product and a Bango ID on the fly in solitude.
@@ -239,39 +555,36 @@ class SolitudeAPI(SlumberWrapper):
             'packageId': seller['bango']['package_id'],
             'secret': 'n'  # This is likely going to be removed.
         })
-        self.slumber.bango.premium.post({
-            'bango': bango['bango_id'],
-            'seller_product_bango': bango['resource_uri'],
-            # TODO(Kumar): why do we still need this?
-            # The array of all possible prices/currencies is
-            # set in the configure billing call.
-            # Marketplace also sets dummy prices here.
-            'price': '0.99',
-            'currencyIso': 'USD',
-        })
-
-        self.slumber.bango.rating.post({
-            'bango': bango['bango_id'],
-            'rating': 'UNIVERSAL',
-            'ratingScheme': 'GLOBAL',
-            'seller_product_bango': bango['resource_uri']
-        })
-        # Bug 836865.
-        self.slumber.bango.rating.post({
-            'bango': bango['bango_id'],
-            'rating': 'GENERAL',
-            'ratingScheme': 'USA',
-            'seller_product_bango': bango['resource_uri']
-        })
+        # These only need the bango product so they are sent at once.
+        run_parallel(
+            functools.partial(self.slumber.bango.premium.post, {
+                'bango': bango['bango_id'],
+                'seller_product_bango': bango['resource_uri'],
+                # TODO(Kumar): why do we still need this?
+                # The array of all possible prices/currencies is
+                # set in the configure billing call.
+                # Marketplace also sets dummy prices here.
+                'price': '0.99',
+                'currencyIso': 'USD',
+            }),
+            functools.partial(self.slumber.bango.rating.post, {
+                'bango': bango['bango_id'],
+                'rating': 'UNIVERSAL',
+                'ratingScheme': 'GLOBAL',
+                'seller_product_bango': bango['resource_uri']
+            }),
+            # Bug 836865.
+            functools.partial(self.slumber.bango.rating.post, {
+                'bango': bango['bango_id'],
+                'rating': 'GENERAL',
+                'ratingScheme': 'USA',
+                'seller_product_bango': bango['resource_uri']
+            }))
 
         return bango['resource_uri']
 
     def get_transaction(self, uuid):
-        transaction = self.slumber.generic.transaction.get(uuid=uuid)
-        # TODO: fix with curling.
-        if len(transaction['objects']) != 1:
-            raise ValueError('No transaction found for %s.' % uuid)
-        transaction = transaction['objects'][0]
+        transaction = self._get_transaction(uuid)
         # Notes may contain some JSON, including the original pay request.
         notes = transaction['notes']
         if notes:
@@ -282,10 +595,28 @@ class SolitudeAPI(SlumberWrapper):
                 transaction['notes']['issuer'] = Issuer.objects.get(pk=issuer)
         return transaction
 
+    def get_transaction_status(self, uuid):
+        """
+        Returns only the status and uid_pay of a transaction.
+
+        This skips decoding the notes, use it when polling.
+        """
+        transaction = self._get_transaction(uuid)
+        return {'status': transaction['status'],
+                'uid_pay': transaction['uid_pay']}
+
+    def _get_transaction(self, uuid):
+        transaction = self.slumber.generic.transaction.get(uuid=uuid)
+        # TODO: fix with curling.
+        if len(transaction['objects']) != 1:
+            raise ValueError('No transaction found for %s.' % uuid)
+        return transaction['objects'][0]
+
 
 if not settings.SOLITUDE_URL:
     # This will typically happen when Sphinx builds the docs.
     warnings.warn('SOLITUDE_URL not found, not setting up client')
-    client = None
+    client = async_client = None
 else:
     client = SolitudeAPI(settings.SOLITUDE_URL, settings.SOLITUDE_OAUTH)
+    async_client = AsyncWrapper(client)
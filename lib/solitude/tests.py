@@ -1,15 +1,21 @@
 import json
+import time
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
+from django.test.utils import override_settings
 
 import mock
 from nose.exc import SkipTest
 from nose.tools import eq_
+from slumber.exceptions import HttpClientError, HttpServerError
 
-from lib.solitude.api import client, SellerNotConfigured
+from lib.utils import LocalCache
+from lib.solitude.api import (client, end_buyer_cache, SellerNotConfigured,
+                              start_buyer_cache)
 from lib.solitude.errors import ERROR_STRINGS
+from webpay.base.tests import local_cache
 from webpay.pay.models import Issuer
 
 
@@ -178,6 +184,149 @@ class SolitudeAPITest(TestCase):
         assert not buyer.get('pin')
 
 
+@mock.patch('lib.solitude.api.client.slumber')
+class BuyerCacheTest(TestCase):
+    uuid = 'some:uuid'
+
+    def setUp(self):
+        self.buyer_ids = {}
+        start_buyer_cache(self.buyer_ids)
+        self.addCleanup(end_buyer_cache)
+
+    def set_buyer(self, slumber, **kw):
+        buyer = {'uuid': self.uuid, 'resource_pk': 5, 'pin': False}
+        buyer.update(kw)
+        slumber.generic.buyer.get.return_value = {'objects': [buyer]}
+
+    def test_get_buyer_once(self, slumber):
+        self.set_buyer(slumber)
+        eq_(client.get_buyer(self.uuid)['id'], 5)
+        eq_(client.get_buyer(self.uuid)['id'], 5)
+        eq_(slumber.generic.buyer.get.call_count, 1)
+        eq_(self.buyer_ids, {self.uuid: 5})
+
+    def test_change_pin_uses_cached_id(self, slumber):
+        self.set_buyer(slumber)
+        client.get_buyer(self.uuid)
+        client.change_pin(self.uuid, '1234')
+        slumber.generic.buyer.assert_called_with(id=5)
+        eq_(slumber.generic.buyer.get.call_count, 1)
+
+    def test_change_pin_refetches_buyer(self, slumber):
+        self.set_buyer(slumber)
+        client.get_buyer(self.uuid)
+        client.change_pin(self.uuid, '1234')
+        self.set_buyer(slumber, pin=True)
+        assert client.get_buyer(self.uuid)['pin']
+        eq_(slumber.generic.buyer.get.call_count, 2)
+
+    def test_id_from_earlier_request(self, slumber):
+        end_buyer_cache()
+        start_buyer_cache({self.uuid: 7})
+        client.set_new_pin(self.uuid, '1234')
+        slumber.generic.buyer.assert_called_with(id=7)
+        assert not slumber.generic.buyer.get.called
+
+    def test_errors_not_cached(self, slumber):
+        slumber.generic.buyer.get.side_effect = HttpClientError(
+            response=mock.Mock(content=json.dumps(
+                {'uuid': ['This field is required.']})))
+        client.get_buyer(self.uuid)
+        client.get_buyer(self.uuid)
+        eq_(slumber.generic.buyer.get.call_count, 2)
+
+    def test_not_cached_outside_requests(self, slumber):
+        end_buyer_cache()
+        self.set_buyer(slumber)
+        client.get_buyer(self.uuid)
+        client.get_buyer(self.uuid)
+        eq_(slumber.generic.buyer.get.call_count, 2)
+
+
+@mock.patch('lib.solitude.api.client.slumber')
+class IssuerCacheTest(TestCase):
+
+    def setUp(self):
+        p = local_cache('lib.solitude.api.cache')
+        self.cache = p.start()
+        self.addCleanup(p.stop)
+
+    def test_cached(self, slumber):
+        slumber.generic.product.get_object.return_value = {
+            'secret': 's', 'access': 1, 'seller': '/generic/seller/1/',
+            'external_id': 'ignored'}
+        eq_(client.get_issuer('app'),
+            {'secret': 's', 'access': 1, 'seller': '/generic/seller/1/'})
+        client.get_issuer('app')
+        eq_(slumber.generic.product.get_object.call_count, 1)
+
+    @override_settings(ISSUER_CACHE_UNKNOWN_TIMEOUT=60)
+    def test_unknown_cached(self, slumber):
+        slumber.generic.product.get_object.side_effect = ObjectDoesNotExist
+        for i in range(2):
+            with self.assertRaises(ObjectDoesNotExist):
+                client.get_issuer('not an app')
+        eq_(slumber.generic.product.get_object.call_count, 1)
+
+    def test_unknown_remembered(self, slumber):
+        slumber.generic.product.get_object.side_effect = ObjectDoesNotExist
+        with mock.patch.object(client, 'unknown_issuers', LocalCache()):
+            with self.assertRaises(ObjectDoesNotExist):
+                client.get_issuer('not an app')
+            self.cache.clear()
+            with self.assertRaises(ObjectDoesNotExist):
+                client.get_issuer('not an app')
+        eq_(slumber.generic.product.get_object.call_count, 1)
+
+    @override_settings(ISSUER_FILTER_REFRESH=60)
+    def test_filtered(self, slumber):
+        slumber.generic.product.get.return_value = {
+            'objects': [{'public_id': 'app'}]}
+        slumber.generic.product.get_object.return_value = {
+            'secret': 's', 'access': 1, 'seller': '/generic/seller/1/'}
+        self.addCleanup(setattr, client, '_issuer_filter_at', 0)
+        client._issuer_filter_at = 0
+        eq_(client.get_issuer('app')['secret'], 's')
+        with self.assertRaises(ObjectDoesNotExist):
+            client.get_issuer('not an app')
+        eq_(slumber.generic.product.get_object.call_count, 1)
+        eq_(slumber.generic.product.get.call_count, 1)
+
+    @override_settings(ISSUER_FILTER_REFRESH=60)
+    def test_filter_unavailable(self, slumber):
+        slumber.generic.product.get.side_effect = HttpServerError
+        self.addCleanup(setattr, client, '_issuer_filter_at', 0)
+        client._issuer_filter_at = 0
+        assert client.may_be_issuer('app')
+
+    def test_forget(self, slumber):
+        slumber.generic.product.get_object.return_value = {
+            'secret': 's', 'access': 1, 'seller': '/generic/seller/1/'}
+        client.get_issuer('app')
+        client.forget_issuer('app')
+        client.get_issuer('app')
+        eq_(slumber.generic.product.get_object.call_count, 2)
+
+    @override_settings(ISSUER_FILTER_REFRESH=60)
+    def test_forget_in_other_process(self, slumber):
+        slumber.generic.product.get.return_value = {
+            'objects': [{'public_id': 'app'}]}
+        slumber.generic.product.get_object.return_value = {
+            'secret': 's', 'access': 1, 'seller': '/generic/seller/1/'}
+        self.addCleanup(setattr, client, '_issuer_filter_at', 0)
+        client._issuer_filter_at = 0
+        with self.assertRaises(ObjectDoesNotExist):
+            client.get_issuer('new app')
+        slumber.generic.product.get.return_value = {
+            'objects': [{'public_id': 'app'}, {'public_id': 'new app'}]}
+        client.forget_issuer('new app')
+        # This process still has a fresh copy of the old filter; only the
+        # shared cache knows about the new issuer.
+        client._issuer_filter_at = time.time()
+        eq_(client.get_issuer('new app')['secret'], 's')
+        eq_(slumber.generic.product.get.call_count, 2)
+
+
 class CreateBangoTest(TestCase):
     uuid = 'some:pin'
     seller = {'bango': {'seller': 's', 'resource_uri': 'r',
@@ -189,19 +338,6 @@ class CreateBangoTest(TestCase):
             client.create_product('ext:id', None,
                                   {'bango': None, 'resource_pk': 'foo'})
 
-    @mock.patch('lib.solitude.api.client.slumber')
-    def test_create_bango(self, slumber):
-        # Temporary mocking. Remove when this is mocked properly.
-        slumber.bango.generic.post.return_value = {'product': 'some:uri'}
-        slumber.bango.product.post.return_value = {'resource_uri': 'some:uri',
-                                                   'bango_id': '5678'}
-        assert client.create_product('ext:id', 'product:name', self.seller)
-        assert slumber.generic.product.post.called
-        kw = slumber.generic.product.post.call_args[0][0]
-        eq_(kw['external_id'], 'ext:id')
-        eq_(slumber.bango.rating.post.call_count, 2)
-        assert slumber.bango.premium.post.called
-
     @mock.patch('lib.solitude.api.client.slumber')
     def test_no_seller(self, slumber):
         slumber.generic.seller.get_object.side_effect = ObjectDoesNotExist
@@ -224,6 +360,109 @@ class CreateBangoTest(TestCase):
         slumber.bango.product.get_object.return_value = {'resource_uri': 'foo'}
         eq_(client.configure_product_for_billing(*range(0, 9)), ('bar', 'foo'))
 
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_seller_passed_in(self, slumber):
+        slumber.bango.billing.post.return_value = {
+            'billingConfigurationId': 'bar'}
+        slumber.bango.product.get_object.return_value = {'resource_uri': 'foo'}
+        eq_(client.configure_product_for_billing(*range(0, 9),
+                                                 seller=self.seller),
+            ('bar', 'foo'))
+        assert not slumber.generic.seller.get_object.called
+
+
+@mock.patch('lib.solitude.api.client.slumber')
+class SellerCacheTest(TestCase):
+    seller = {'uuid': 'seller-uuid', 'resource_pk': 1,
+              'bango': {'seller': 's', 'resource_uri': 'r'}}
+
+    def setUp(self):
+        p = local_cache('lib.solitude.api.cache')
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_by_uuid(self, slumber):
+        slumber.generic.seller.get_object.return_value = self.seller
+        eq_(client.get_seller('seller-uuid'), self.seller)
+        eq_(client.get_seller('seller-uuid'), self.seller)
+        eq_(slumber.generic.seller.get_object.call_count, 1)
+
+    @mock.patch('lib.solitude.api.client.get_issuer')
+    def test_by_issuer(self, get_issuer, slumber):
+        get_issuer.return_value = {'seller': '/generic/seller/1/'}
+        seller = slumber.generic.seller.return_value
+        seller.get_object_or_404.return_value = self.seller
+        eq_(client.get_issuer_seller('app'), self.seller)
+        eq_(client.get_issuer_seller('app'), self.seller)
+        slumber.generic.seller.assert_called_with('1')
+        eq_(seller.get_object_or_404.call_count, 1)
+        get_issuer.assert_called_with('app')
+        assert not slumber.generic.product.called
+        # It is also found by uuid.
+        eq_(client.get_seller('seller-uuid'), self.seller)
+        assert not slumber.generic.seller.get_object.called
+
+    @mock.patch('lib.solitude.api.client.get_issuer')
+    def test_forget_issuer(self, get_issuer, slumber):
+        get_issuer.return_value = {'seller': '/generic/seller/1/'}
+        seller = slumber.generic.seller.return_value
+        seller.get_object_or_404.return_value = self.seller
+        client.get_issuer_seller('app')
+        client.forget_issuer('app')
+        slumber.generic.seller.get_object.return_value = self.seller
+        client.get_seller('seller-uuid')
+        client.get_issuer_seller('app')
+        eq_(seller.get_object_or_404.call_count, 2)
+        eq_(slumber.generic.seller.get_object.call_count, 1)
+
+
+@mock.patch('lib.solitude.api.client.slumber')
+class BangoProductCacheTest(TestCase):
+    seller = {'bango': {'seller': 's', 'resource_uri': 'r'},
+              'resource_pk': 'foo'}
+
+    def setUp(self):
+        p = local_cache('lib.solitude.api.cache')
+        self.cache = p.start()
+        self.addCleanup(p.stop)
+
+    def test_cached(self, slumber):
+        slumber.bango.product.get_object.return_value = {'resource_uri': 'u'}
+        eq_(client.get_bango_product(self.seller, 'ext:id', 'name'), 'u')
+        eq_(client.get_bango_product(self.seller, 'ext:id', 'name'), 'u')
+        eq_(slumber.bango.product.get_object.call_count, 1)
+
+    @mock.patch('lib.solitude.api.client.create_product')
+    def test_created_once(self, create_product, slumber):
+        slumber.bango.product.get_object.side_effect = ObjectDoesNotExist
+        create_product.return_value = 'u'
+        eq_(client.get_bango_product(self.seller, 'ext:id', 'name'), 'u')
+        eq_(client.get_bango_product(self.seller, 'ext:id', 'name'), 'u')
+        eq_(create_product.call_count, 1)
+
+    @mock.patch('lib.solitude.api.client.create_product')
+    @mock.patch('lib.solitude.api.time.sleep')
+    def test_wait_for_creator(self, sleep, create_product, slumber):
+        slumber.bango.product.get_object.side_effect = ObjectDoesNotExist
+        key = client._seller_key('bango-product:foo', 'ext:id')
+        self.cache.add(key + ':lock', True)
+        # Another process creates the product while this one waits.
+        sleep.side_effect = lambda s: self.cache.set(key, 'u')
+        eq_(client.get_bango_product(self.seller, 'ext:id', 'name'), 'u')
+        assert not create_product.called
+
+    @mock.patch('lib.solitude.api.client.create_product')
+    @mock.patch('lib.solitude.api.time.sleep')
+    def test_give_up_waiting(self, sleep, create_product, slumber):
+        slumber.bango.product.get_object.side_effect = ObjectDoesNotExist
+        create_product.return_value = 'u'
+        # Like a cache that is down, the lock can never be taken.
+        self.cache.add = mock.Mock(return_value=False)
+        with self.settings(BANGO_PRODUCT_LOCK_TIMEOUT=0):
+            eq_(client.get_bango_product(self.seller, 'ext:id', 'name'),
+                'u')
+        eq_(create_product.call_count, 1)
+
 
 @mock.patch('lib.solitude.api.client.slumber')
 class TransactionTest(TestCase):
@@ -252,3 +491,10 @@ class TransactionTest(TestCase):
         ]}
         trans = client.get_transaction('x')
         eq_(trans['notes']['issuer'], iss)
+
+    def test_transaction_status(self, slumber):
+        slumber.generic.transaction.get.return_value = {'objects': [
+            {'notes': 'not json', 'status': 0, 'uid_pay': 123}
+        ]}
+        eq_(client.get_transaction_status('x'),
+            {'status': 0, 'uid_pay': 123})
@@ -0,0 +1,226 @@
+import functools
+import threading
+import time
+
+from django.test import TestCase
+
+import mock
+from nose.tools import eq_, raises
+
+from requests.exceptions import Timeout
+
+from lib.utils import (AsyncWrapper, BloomFilter, CallTimeout, get_session,
+                       LocalCache, PooledSession, run_parallel, TimedSession)
+from webpay.base.logger import (end_calls, get_transaction_id, record_call,
+                                set_transaction_id, start_calls)
+
+
+class TestLocalCache(TestCase):
+
+    def test_get_set(self):
+        cache = LocalCache()
+        cache.set('foo', 'bar')
+        eq_(cache.get('foo'), 'bar')
+        eq_(cache.get('baz', 'default'), 'default')
+
+    def test_least_recently_used(self):
+        cache = LocalCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('c'), 3)
+
+    @mock.patch('lib.utils.time.time')
+    def test_timeout(self, time):
+        cache = LocalCache(timeout=10)
+        time.return_value = 100
+        cache.set('foo', 'bar')
+        time.return_value = 109
+        eq_(cache.get('foo'), 'bar')
+        time.return_value = 110
+        eq_(cache.get('foo'), None)
+
+
+class TestBloomFilter(TestCase):
+
+    def test_added(self):
+        issuers = BloomFilter(100)
+        for i in range(100):
+            issuers.add('app-%s' % i)
+        assert all('app-%s' % i in issuers for i in range(100))
+
+    def test_not_added(self):
+        issuers = BloomFilter(100, error_rate=0.01)
+        for i in range(100):
+            issuers.add('app-%s' % i)
+        found = sum(1 for i in range(1000) if 'junk-%s' % i in issuers)
+        assert found < 50, found
+
+    def test_unicode(self):
+        issuers = BloomFilter(1)
+        issuers.add(u'\u0540')
+        assert u'\u0540' in issuers
+
+
+@mock.patch('lib.utils.requests.session')
+class TestPooledSession(TestCase):
+
+    def test_shared(self, session):
+        eq_(get_session('some.host'), get_session('some.host'))
+
+    def test_config(self, session):
+        pools = {'default': {'pool_connections': 1, 'pool_maxsize': 2,
+                             'keep_alive': True, 'timeout': 3},
+                 'some.host': {'pool_maxsize': 5}}
+        with self.settings(HTTP_POOLS=pools):
+            PooledSession('some.host').get('http://some.host/')
+        session.assert_called_with(timeout=3,
+                                   config={'keep_alive': True,
+                                           'pool_connections': 1,
+                                           'pool_maxsize': 5})
+        session.return_value.request.assert_called_with(
+            'GET', 'http://some.host/')
+
+    @mock.patch('lib.utils.os.getpid')
+    def test_new_session_after_fork(self, getpid, session):
+        pool = PooledSession('some.host')
+        getpid.return_value = 1
+        pool.get('http://some.host/')
+        pool.get('http://some.host/')
+        eq_(session.call_count, 1)
+        getpid.return_value = 2
+        pool.get('http://some.host/')
+        eq_(session.call_count, 2)
+
+    @mock.patch('lib.utils.statsd')
+    def test_stats(self, statsd, session):
+        PooledSession('some.host:80').post('http://some.host/', {})
+        statsd.incr.assert_called_with('http.pool.some_host_80.checkout')
+        statsd.gauge.assert_called_with('http.pool.some_host_80.in_use', 1)
+
+    @mock.patch('lib.utils.statsd')
+    def test_wait_per_host(self, statsd, session):
+        pools = {'default': {'pool_connections': 10, 'pool_maxsize': 1,
+                             'keep_alive': True, 'timeout': 3}}
+        with self.settings(HTTP_POOLS=pools):
+            pool = PooledSession('postbacks')
+
+        def request(method, url, **kw):
+            if url == 'http://a.host/':
+                # A request to another host while this one is in use.
+                pool.get('http://b.host/')
+                assert not statsd.incr.call_args_list.count(
+                    mock.call('http.pool.postbacks.wait'))
+                pool.get('http://a.host/again')
+        session.return_value.request.side_effect = request
+        pool.get('http://a.host/')
+        eq_(statsd.incr.call_args_list.count(
+            mock.call('http.pool.postbacks.wait')), 1)
+
+
+@mock.patch('lib.utils.statsd')
+class TestTimedSession(TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.session.request.return_value.status_code = 201
+        self.timed = TimedSession('solitude', self.session, '/api/')
+        start_calls()
+        self.addCleanup(end_calls)
+
+    def test_stat(self, statsd):
+        eq_(self.timed.stat('PATCH', 'http://s/api/generic/buyer/12/?a=1'),
+            'http.solitude.generic.buyer.id.patch')
+        eq_(self.timed.stat('GET', 'http://s/api/webpay/'
+                                   '3fa85f64-5717-4562-b3fc-2c963f66afa6/'),
+            'http.solitude.webpay.id.get')
+        eq_(self.timed.stat('GET', 'http://s/api/'), 'http.solitude.root.get')
+
+    def test_timed(self, statsd):
+        self.timed.request('POST', 'http://s/api/generic/buyer/', data='{}')
+        eq_(statsd.timing.call_args[0][0], 'http.solitude.generic.buyer.post')
+        statsd.incr.assert_any_call('http.solitude.generic.buyer.post')
+        statsd.incr.assert_any_call('http.solitude.generic.buyer.post.2xx')
+        calls = end_calls()
+        eq_(calls.services['solitude'][0], 1)
+        eq_(calls.resources['http.solitude.generic.buyer.post'][0], 1)
+
+    @raises(Timeout)
+    def test_error(self, statsd):
+        self.session.request.side_effect = Timeout
+        try:
+            self.timed.request('GET', 'http://s/api/generic/buyer/')
+        finally:
+            statsd.incr.assert_any_call(
+                'http.solitude.generic.buyer.get.error.Timeout')
+            statsd.incr.assert_any_call('http.solitude.error')
+            eq_(end_calls().services['solitude'][0], 1)
+
+
+class TestRunParallel(TestCase):
+
+    def test_results_in_order(self):
+        eq_(run_parallel(lambda: 1, functools.partial(max, 1, 2)), [1, 2])
+
+    @raises(ValueError)
+    def test_exception_raised(self):
+        def fail():
+            raise ValueError('nope')
+        run_parallel(lambda: 1, fail)
+
+    @raises(CallTimeout)
+    def test_timeout(self):
+        run_parallel(functools.partial(time.sleep, 1), timeout=0.01)
+
+    def test_transaction_id(self):
+        set_transaction_id('some:trans')
+        self.addCleanup(set_transaction_id, None)
+        eq_(run_parallel(get_transaction_id), ['some:trans'])
+
+    def test_calls(self):
+        start_calls()
+        self.addCleanup(end_calls)
+        run_parallel(functools.partial(record_call, 'solitude', 10),
+                     functools.partial(record_call, 'solitude', 20))
+        eq_(end_calls().services, {'solitude': [2, 30]})
+
+    def test_nested(self):
+        eq_(run_parallel(lambda: run_parallel(lambda: 1, lambda: 2)),
+            [[1, 2]])
+
+    def test_nested_in_parallel(self):
+        both = threading.Event()
+        started = []
+
+        def wait():
+            started.append(1)
+            if len(started) == 2:
+                both.set()
+            return both.wait(5) or both.isSet()
+
+        eq_(run_parallel(lambda: run_parallel(wait, wait)), [[True, True]])
+
+
+class TestAsyncWrapper(TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.errors = {}
+        self.async = AsyncWrapper(self.client)
+
+    def test_result(self):
+        self.client.get_buyer.return_value = {'uuid': 'some-uuid'}
+        future = self.async.get_buyer('some-uuid', extra=True)
+        eq_(future.result(1), {'uuid': 'some-uuid'})
+        self.client.get_buyer.assert_called_with('some-uuid', extra=True)
+
+    @raises(ValueError)
+    def test_exception(self):
+        self.client.get_transaction.side_effect = ValueError
+        self.async.get_transaction('some:trans').result(1)
+
+    def test_attribute(self):
+        eq_(self.async.errors, {})
@@ -1,22 +1,401 @@
+import contextlib
+import functools
+import hashlib
 import json
+import math
+import os
+import Queue
+import re
+import struct
+import sys
+import threading
+import time
+from urlparse import urlparse
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict  # Python 2.6
+
+from django.conf import settings
+from django.utils.encoding import smart_str
 
 from curling.lib import API
+from django_statsd.clients import statsd
+import requests
 from slumber.exceptions import HttpClientError
 
-from webpay.base.logger import get_transaction_id
+from webpay.base.logger import (get_calls, get_transaction_id, record_call,
+                                set_calls, set_transaction_id)
+
+# Path segments that are ids, such as resource_pks and uuids.
+_id_re = re.compile(r'^(\d+|[0-9a-f]{8,}(-[0-9a-f]+)*)$', re.I)
 
 
 def add_transaction_id(slumber, headers=None, **kwargs):
     headers['Transaction-Id'] = get_transaction_id()
 
 
+class LocalCache(object):
+    """
+    A small process-local LRU cache.
+
+    :param size: maximum number of entries to keep.
+    :param timeout: seconds an entry stays valid for, None to never expire.
+
+    This is not shared between processes. Use it in front of the Django
+    cache for hot data that rarely changes.
+    """
+
+    def __init__(self, size=100, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            # Re-insert to mark this as the most recently used entry.
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.timeout is not None:
+            expires = time.time() + self.timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class BloomFilter(object):
+    """
+    A compact set that can say for sure that an item was never added.
+
+    :param capacity: number of items expected to be added.
+    :param error_rate: chance of an item that wasn't added being found.
+
+    Items that were added are always found. It can be pickled to share it
+    through the Django cache.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) /
+                            math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size * math.log(2) / capacity)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        a, b = struct.unpack('<QQ', hashlib.md5(smart_str(item)).digest())
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, item):
+        return all(self.bits[pos // 8] & (1 << (pos % 8))
+                   for pos in self._positions(item))
+
+
+class PooledSession(object):
+    """
+    A requests session that keeps connections alive between requests.
+
+    :param name: name of the pool in settings.HTTP_POOLS, usually a host.
+
+    The underlying session is created lazily in each process so that
+    forked workers, such as celery prefork workers, never share sockets.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.config = dict(settings.HTTP_POOLS['default'])
+        self.config.update(settings.HTTP_POOLS.get(name, {}))
+        self.stat = 'http.pool.%s' % re.sub(r'[^\w-]', '_', name)
+        self._pid = None
+        self._session = None
+        # Connections in use to each host, which pool_maxsize applies to.
+        self._in_use = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            config = dict((k, self.config[k]) for k in
+                          ('keep_alive', 'pool_connections', 'pool_maxsize'))
+            with self._lock:
+                if self._pid != pid:
+                    self._session = requests.session(
+                        timeout=self.config['timeout'], config=config)
+                    self._in_use = {}
+                    self._pid = pid
+        return self._session
+
+    def request(self, method, url, **kw):
+        session = self.session
+        parsed = urlparse(url)
+        host = (parsed.scheme, parsed.netloc)
+        with self._lock:
+            in_use = self._in_use[host] = self._in_use.get(host, 0) + 1
+        statsd.incr('%s.checkout' % self.stat)
+        statsd.gauge('%s.in_use' % self.stat, in_use)
+        if in_use > self.config['pool_maxsize']:
+            # There are no idle connections to this host left so this
+            # request waits on a new connection which won't be kept alive.
+            statsd.incr('%s.wait' % self.stat)
+        try:
+            return session.request(method, url, **kw)
+        finally:
+            with self._lock:
+                self._in_use[host] -= 1
+                if not self._in_use[host]:
+                    del self._in_use[host]
+
+    def get(self, url, **kw):
+        return self.request('GET', url, **kw)
+
+    def post(self, url, data=None, **kw):
+        return self.request('POST', url, data=data, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name):
+    """
+    Returns the PooledSession shared by everything connecting to name.
+    """
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = PooledSession(name)
+        return _sessions[name]
+
+
+@contextlib.contextmanager
+def timed(service, stat):
+    """
+    Times a call to an outside service.
+
+    :param service: name of the service, such as 'persona'.
+    :param stat: statsd name to time the call as.
+
+    Errors are counted by exception class in <stat>.error.<class> and in
+    http.<service>.error. The call is added to the totals for the current
+    request under both service and stat.
+    """
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        statsd.incr('%s.error.%s' % (stat, e.__class__.__name__))
+        statsd.incr('http.%s.error' % service)
+        raise
+    finally:
+        ms = int((time.time() - start) * 1000)
+        statsd.timing(stat, ms)
+        statsd.incr(stat)
+        record_call(service, ms, stat)
+
+
+class TimedSession(object):
+    """
+    Times every request made through a session.
+
+    :param service: name of the service in stats, such as 'solitude'.
+    :param session: the session to make requests with.
+    :param base: URL path of the API, which is left out of stat names.
+
+    Requests are timed and counted as http.<service>.<resource>.<method>,
+    where resource is the URL path with any ids left out, such as
+    http.solitude.generic.buyer.patch. Responses are counted by status
+    class in <stat>.2xx, <stat>.4xx and so on.
+    """
+
+    def __init__(self, service, session, base=''):
+        self.service = service
+        self.session = session
+        self.base = base.rstrip('/')
+
+    def stat(self, method, url):
+        path = urlparse(url).path
+        if path.startswith(self.base):
+            path = path[len(self.base):]
+        resource = '.'.join('id' if _id_re.match(part)
+                            else re.sub(r'[^\w-]', '_', part)
+                            for part in path.split('/') if part)
+        return 'http.%s.%s.%s' % (self.service, resource or 'root',
+                                  method.lower())
+
+    def request(self, method, url, **kw):
+        stat = self.stat(method, url)
+        with timed(self.service, stat):
+            res = self.session.request(method, url, **kw)
+        statsd.incr('%s.%sxx' % (stat, res.status_code // 100))
+        return res
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class CallTimeout(Exception):
+    """A call run by run_parallel() did not finish in time."""
+
+
+class Future(object):
+    """The result of a call that is running in an Executor thread."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the call and returns its result or raises its exception.
+        """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise CallTimeout('Call did not finish in %s seconds' % timeout)
+        if self._exc_info:
+            etype, val, tb = self._exc_info
+            raise etype, val, tb
+        return self._result
+
+
+_executor_local = threading.local()
+
+
+class Executor(object):
+    """
+    A fixed number of threads that run calls in the background.
+
+    :param workers: number of threads.
+    :param nested_workers: number of threads in a second pool that runs
+                           calls submitted from this executor's threads.
+
+    Threads are started lazily in each process so that forked workers
+    get their own.
+    """
+
+    def __init__(self, workers, nested_workers=0):
+        self.workers = workers
+        self.nested = Executor(nested_workers) if nested_workers else None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(self._queue,))
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self, queue):
+        _executor_local.executor = self
+        while True:
+            future, func, transaction_id, calls = queue.get()
+            # Solitude calls are tagged with the transaction being worked
+            # on by the caller and add to the caller's request totals.
+            set_transaction_id(transaction_id)
+            set_calls(calls)
+            try:
+                future.set_result(func())
+            except:
+                future.set_exc_info(sys.exc_info())
+
+    def submit(self, func):
+        """Runs func() in a thread and returns a Future for it."""
+        future = Future()
+        current = getattr(_executor_local, 'executor', None)
+        if current is self and self.nested:
+            # Calls made by this executor's threads run in the nested pool,
+            # whose threads never wait on either pool.
+            return self.nested._put(future, func)
+        if current is not None:
+            # Waiting on other calls from inside an executor thread could use
+            # up every thread, so run this one right here instead.
+            try:
+                future.set_result(func())
+            except:
+                future.set_exc_info(sys.exc_info())
+            return future
+        return self._put(future, func)
+
+    def _put(self, future, func):
+        self._start()
+        self._queue.put((future, func, get_transaction_id(), get_calls()))
+        return future
+
+
+def run_parallel(*funcs, **kw):
+    """
+    Calls each function at the same time and returns their results.
+
+    :param funcs: functions that take no arguments; use functools.partial
+                  to bind any.
+    :param timeout: seconds to wait for each call, defaults to
+                    settings.PARALLEL_TIMEOUT.
+    :rtype: list of results in the same order as funcs.
+
+    If a call raises an exception it is raised here. A call that takes
+    too long raises CallTimeout but it keeps running in the background.
+    """
+    timeout = kw.get('timeout', settings.PARALLEL_TIMEOUT)
+    deadline = time.time() + timeout
+    futures = [executor.submit(func) for func in funcs]
+    return [f.result(max(deadline - time.time(), 0)) for f in futures]
+
+
 class SlumberWrapper(object):
     """
     A wrapper around the Slumber API.
+
+    Every call is timed in statsd under http.<service>.
     """
+    service = 'api'
 
     def __init__(self, url, oauth):
         self.slumber = API(url)
+        parsed = urlparse(url)
+        # This has to be set before any resources are created from the API.
+        self.slumber._store['session'] = TimedSession(
+            self.service, get_session(parsed.netloc), parsed.path)
         self.slumber.activate_oauth(oauth.get('key'), oauth.get('secret'))
         self.slumber._add_callback({'method': add_transaction_id})
         self.api = self.slumber.api.v1
@@ -37,3 +416,35 @@ class SlumberWrapper(object):
                 res[key] = [self.errors[v] for v in value]
             return {'errors': res}
         return res
+
+
+class AsyncWrapper(object):
+    """
+    Gives a SlumberWrapper client methods that don't block.
+
+    Every method takes the same arguments as on the client but runs in
+    the executor and returns a Future right away, for example::
+
+        buyer = async_client.get_buyer(uuid)
+        ...
+        buyer.result()
+
+    Calls go through the client so they share its connection pool, OAuth
+    signing, Transaction-Id header and safe_run error handling.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def submit(*args, **kw):
+            return executor.submit(functools.partial(attr, *args, **kw))
+        return submit
+
+
+executor = Executor(settings.PARALLEL_WORKERS,
+                    settings.PARALLEL_NESTED_WORKERS)
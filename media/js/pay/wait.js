@@ -18,14 +18,16 @@ require(['cli'], function(cli) {
                 }
                 window.location = data.url;
             } else {
-                // The transaction is pending or it failed.
+                // The transaction isn't ready yet so ask again.
                 // TODO(Kumar) check for failed transactions here.
-                console.log('transaction state: ' + data.state)
+                console.log('transaction state: ' + data.status);
                 timeout = window.setTimeout(poll, 1000);
             }
         })
         .error(function() {
+            // Try again in a little while.
             console.log('error checking transaction');
+            timeout = window.setTimeout(poll, 5000);
         });
     }
 
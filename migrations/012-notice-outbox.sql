@@ -0,0 +1,14 @@
+CREATE TABLE `notice_outbox` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `transaction_uuid` varchar(255) NOT NULL,
+    `notice_type` integer NOT NULL,
+    `reason` varchar(255) NOT NULL,
+    `attempts` integer NOT NULL,
+    `held` integer NOT NULL,
+    `next_attempt` datetime NOT NULL,
+    `claim` varchar(32),
+    `last_error` varchar(255),
+    `created` datetime NOT NULL
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
+CREATE INDEX `notice_outbox_next_attempt` ON `notice_outbox` (`next_attempt`);
+CREATE INDEX `notice_outbox_claim` ON `notice_outbox` (`claim`);
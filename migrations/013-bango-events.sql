@@ -0,0 +1,11 @@
+CREATE TABLE `bango_events` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `notification` longtext NOT NULL,
+    `attempts` integer NOT NULL,
+    `next_attempt` datetime NOT NULL,
+    `claim` varchar(32),
+    `last_error` varchar(255),
+    `created` datetime NOT NULL
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
+CREATE INDEX `bango_events_next_attempt` ON `bango_events` (`next_attempt`);
+CREATE INDEX `bango_events_claim` ON `bango_events` (`claim`);
@@ -0,0 +1,7 @@
+CREATE TABLE `task_args` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `key` varchar(64) NOT NULL UNIQUE,
+    `value` longtext NOT NULL,
+    `created` datetime NOT NULL
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
+CREATE INDEX `task_args_created` ON `task_args` (`created`);
@@ -35,3 +35,21 @@ MARKETPLACE_URL = SOLITUDE_URL = 'http://example.com'
 # If you want test this, do so explicitly in the tests.
 USER_WHITELIST = []
 UUID_HMAC_KEY = 'this is a test value'
+
+# Don't share cached data between tests. Tests that check caching should
+# patch in a real cache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+# Always look up price points from the (mocked) Marketplace API.
+PRICE_CACHE_TIMEOUT = 0
+
+# Don't remember JWT issuers between tests.
+ISSUER_CACHE_UNKNOWN_TIMEOUT = 0
+ISSUER_FILTER_REFRESH = 0
+
+# Don't hold trans_start_url requests open.
+TRANS_START_WAIT = 0
@@ -0,0 +1,21 @@
+from lib.solitude.api import end_buyer_cache, start_buyer_cache
+
+
+class BuyerCacheMiddleware(object):
+    """
+    Only fetch each buyer from solitude once per request.
+
+    Buyer ids are kept in the session so that changing a buyer doesn't
+    require fetching it first.
+    """
+
+    def process_request(self, request):
+        start_buyer_cache(dict(request.session.get('uuid_buyer_ids', {})))
+
+    def process_response(self, request, response):
+        buyer_ids = end_buyer_cache()
+        session = getattr(request, 'session', None)
+        if (buyer_ids is not None and session is not None and
+            buyer_ids != session.get('uuid_buyer_ids', {})):
+            session['uuid_buyer_ids'] = buyer_ids
+        return response
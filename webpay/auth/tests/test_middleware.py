@@ -1,6 +1,11 @@
+from django import test
 from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
 
 from mock import patch
+from nose.tools import eq_
+
+from webpay.auth.middleware import BuyerCacheMiddleware
 
 from . import SessionTestCase
 
@@ -18,3 +23,31 @@ class ParanoidPinFormTest(SessionTestCase):
         self.verify('fake', request_meta={'HTTP_USER_AGENT': 'foo'})
         self.client.post(reverse('monitor'), HTTP_USER_AGENT='bar')
         assert report.called
+
+
+class BuyerCacheMiddlewareTest(test.TestCase):
+
+    def setUp(self):
+        self.middleware = BuyerCacheMiddleware()
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+
+    @patch.object(solitude, 'slumber')
+    def test_buyer_ids_saved_in_session(self, sol):
+        sol.generic.buyer.get.return_value = {
+            'objects': [{'uuid': 'fake', 'resource_pk': 5}]}
+        self.middleware.process_request(self.request)
+        solitude.get_buyer('fake')
+        solitude.get_buyer('fake')
+        self.middleware.process_response(self.request, None)
+        eq_(self.request.session['uuid_buyer_ids'], {'fake': 5})
+        eq_(sol.generic.buyer.get.call_count, 1)
+
+    @patch.object(solitude, 'slumber')
+    def test_buyer_ids_from_session(self, sol):
+        self.request.session['uuid_buyer_ids'] = {'fake': 5}
+        self.middleware.process_request(self.request)
+        solitude.change_pin('fake', '1234')
+        self.middleware.process_response(self.request, None)
+        sol.generic.buyer.assert_called_with(id=5)
+        assert not sol.generic.buyer.get.called
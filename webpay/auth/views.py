@@ -7,6 +7,7 @@ from django_browserid import get_audience, verify as verify_assertion
 from django_browserid.forms import BrowserIDForm
 from session_csrf import anonymous_csrf_exempt
 
+from lib.utils import timed
 from webpay.base.decorators import json_view
 from webpay.base.logger import getLogger
 from webpay.pay import tasks as pay_tasks
@@ -16,6 +17,12 @@ from .utils import get_uuid, set_user
 log = getLogger('w.auth')
 
 
+def verify_persona(assertion, audience, extra_params):
+    """Verifies a Persona assertion, timed as http.persona.verify."""
+    with timed('persona', 'http.persona.verify'):
+        return verify_assertion(assertion, audience, extra_params)
+
+
 @require_POST
 def reset_user(request):
     """
@@ -26,8 +33,8 @@ def reset_user(request):
     is logged out.
     """
     if request.session.get('logged_in_user'):
-        log.info('Resetting Persona user %s'
-                 % request.session['logged_in_user'])
+        log.info('Resetting Persona user %s',
+                 request.session['logged_in_user'])
         del request.session['logged_in_user']
     return http.HttpResponse('OK')
 
@@ -47,11 +54,11 @@ def reverify(request):
         }
 
         log.info('Re-verifying Persona assertion. url: %s, audience: %s, '
-                 'extra_params: %s' % (url, audience, extra_params))
-        result = verify_assertion(form.cleaned_data['assertion'], audience,
-                                  extra_params)
+                 'extra_params: %s', url, audience, extra_params)
+        result = verify_persona(form.cleaned_data['assertion'], audience,
+                                extra_params)
 
-        log.info('Reverify got result: %s' % result)
+        log.info('Reverify got result: %s', result)
         if result:
             logged_user = request.session.get('uuid')
             email = result.get('unverified-email', result.get('email'))
@@ -85,11 +92,11 @@ def verify(request):
         assertion = form.cleaned_data['assertion']
 
         log.info('verifying Persona assertion. url: %s, audience: %s, '
-                 'extra_params: %s, assertion: %s' % (url, audience,
-                                                      extra_params, assertion))
-        result = verify_assertion(assertion, audience, extra_params)
+                 'extra_params: %s, assertion: %s', url, audience,
+                 extra_params, assertion)
+        result = verify_persona(assertion, audience, extra_params)
         if result:
-            log.info('Persona assertion ok: %s' % result)
+            log.info('Persona assertion ok: %s', result)
             email = result.get('unverified-email', result.get('email'))
             user_uuid = set_user(request, email)
 
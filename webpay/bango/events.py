@@ -0,0 +1,117 @@
+"""
+Buffered Bango Event Notifications.
+
+With BANGO_EVENT_QUEUE on, the notification view checks the Basic auth
+credentials against BANGO_EVENT_USERNAME and BANGO_EVENT_PASSWORD, saves
+the event and answers Bango straight away. The credentials aren't saved;
+events are forwarded with the configured ones.
+Events are forwarded to Solitude in the background by forward(), which
+runs from the forward_events task and the forward_bango_events command.
+A slow or failing Solitude then doesn't make Bango send events again.
+"""
+from datetime import datetime
+import functools
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+
+from lib.solitude.api import client
+from lib.utils import executor
+from webpay.base.logger import getLogger
+from webpay.pay import outbox
+from webpay.pay.utils import format_exception
+
+from .models import BangoEvent
+
+log = getLogger('w.bango.events')
+
+# Held while a forward_events task is queued or running.
+FORWARD_LOCK = 'bango:events:forward'
+
+
+def add(notification):
+    """Saves an event to be forwarded and returns its row."""
+    return BangoEvent.objects.create(notification=notification,
+                                     next_attempt=datetime.now())
+
+
+def _post(event):
+    try:
+        client.slumber.bango.event.post({
+            'notification': event.notification,
+            'password': settings.BANGO_EVENT_PASSWORD,
+            'username': settings.BANGO_EVENT_USERNAME
+        })
+    except Exception, err:
+        log.error('Error forwarding Bango event %s: %s' % (event.pk, err),
+                  exc_info=True)
+        return err
+
+
+def backoff(attempts):
+    return min(settings.BANGO_EVENT_DELAY * 2 ** (attempts - 1),
+               settings.BANGO_EVENT_MAX_DELAY)
+
+
+def forward(batch_size=None):
+    """
+    Forwards events that are due to Solitude and returns how many were
+    forwarded.
+
+    Each batch is posted at the same time. Once any event in a batch
+    fails the rest are left for later so a struggling Solitude isn't sent
+    more. Failed events are retried with a growing delay until
+    BANGO_EVENT_ATTEMPTS tries have been made.
+    """
+    batch_size = batch_size or settings.BANGO_EVENT_BATCH
+    forwarded = 0
+    while True:
+        events = outbox.claim(batch_size, model=BangoEvent,
+                              timeout=settings.BANGO_EVENT_CLAIM_TIMEOUT)
+        if not events:
+            return forwarded
+        sent = _forward_batch(events)
+        forwarded += sent
+        statsd.incr('bango.events.forwarded', sent)
+        if sent < len(events):
+            return forwarded
+
+
+def _forward_batch(events):
+    """Posts a claimed batch and returns how many events were sent."""
+    futures = [executor.submit(functools.partial(_post, e))
+               for e in events]
+    # Every post is waited for, however long it takes, so that an event
+    # is never released while it could still reach Solitude. Posts give
+    # up on their own after the HTTP pool's timeout.
+    errors = [future.result() for future in futures]
+    unfinished = list(events)
+    done = []
+    sent = 0
+    try:
+        for event, err in zip(events, errors):
+            if err is None:
+                done.append(event)
+                sent += 1
+            else:
+                event.attempts += 1
+                if event.attempts >= settings.BANGO_EVENT_ATTEMPTS:
+                    log.error('Giving up on Bango event %s after %s '
+                              'attempts' % (event.pk, event.attempts))
+                    statsd.incr('bango.events.failed')
+                    done.append(event)
+                else:
+                    outbox.reschedule(event, backoff(event.attempts),
+                                      format_exception(err))
+            unfinished.remove(event)
+    finally:
+        outbox.remove(done)
+        for event in unfinished:
+            # Something went wrong before this event was dealt with, so
+            # let it be claimed again straight away.
+            try:
+                outbox.reschedule(event, 0, event.last_error)
+            except Exception:
+                log.exception('while releasing Bango event %s' % event.pk)
+    return sent
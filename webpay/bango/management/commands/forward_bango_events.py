@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from webpay.bango import events
+
+
+class Command(BaseCommand):
+    help = ('Forward saved Bango Event Notifications to Solitude. This is '
+            'meant to be run from cron.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int',
+                    help='Events to forward at a time. Default is '
+                         'settings.BANGO_EVENT_BATCH.'),
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Forwarded %s Bango events\n'
+                          % events.forward(options['batch']))
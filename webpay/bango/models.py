@@ -0,0 +1,20 @@
+from django.db import models
+
+
+class BangoEvent(models.Model):
+    """
+    A Bango Event Notification waiting to be forwarded to Solitude.
+
+    Only events whose Basic auth credentials were checked when they were
+    received are saved. The row is deleted once it has been forwarded.
+    """
+    notification = models.TextField()
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    claim = models.CharField(max_length=32, null=True, blank=True,
+                             db_index=True)
+    last_error = models.CharField(max_length=255, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'bango_events'
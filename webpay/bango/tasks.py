@@ -0,0 +1,18 @@
+from django.core.cache import cache
+
+from celeryutils import task
+
+from webpay.base.logger import getLogger
+
+from . import events
+
+log = getLogger('w.bango.tasks')
+
+
+@task
+def forward_events(**kw):
+    """Forwards saved Bango Event Notifications to Solitude."""
+    try:
+        log.info('Forwarded %s Bango events' % events.forward())
+    finally:
+        cache.delete(events.FORWARD_LOCK)
@@ -0,0 +1,66 @@
+from datetime import datetime
+
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_
+from slumber.exceptions import HttpServerError
+from test_utils import TestCase
+
+from webpay.bango import events
+from webpay.bango.models import BangoEvent
+
+
+@override_settings(BANGO_EVENT_ATTEMPTS=2, BANGO_EVENT_BATCH=2,
+                   BANGO_EVENT_USERNAME='u', BANGO_EVENT_PASSWORD='p')
+@mock.patch('webpay.bango.events.client.slumber')
+class TestForward(TestCase):
+
+    def test_forward(self, slumber):
+        for i in range(3):
+            events.add('<xml/>')
+        eq_(events.forward(), 3)
+        eq_(slumber.bango.event.post.call_count, 3)
+        slumber.bango.event.post.assert_called_with(
+            {'notification': '<xml/>', 'username': 'u', 'password': 'p'})
+        eq_(BangoEvent.objects.count(), 0)
+
+    def test_stop_on_failure(self, slumber):
+        slumber.bango.event.post.side_effect = HttpServerError('500')
+        for i in range(3):
+            events.add('<xml/>')
+        eq_(events.forward(), 0)
+        # Only the first batch was tried.
+        eq_(slumber.bango.event.post.call_count, 2)
+        retried = BangoEvent.objects.filter(attempts=1)
+        eq_(retried.count(), 2)
+        assert all(e.next_attempt > datetime.now() for e in retried)
+
+    def test_give_up(self, slumber):
+        slumber.bango.event.post.side_effect = HttpServerError('500')
+        event = events.add('<xml/>')
+        BangoEvent.objects.filter(pk=event.pk).update(attempts=1)
+        events.forward()
+        eq_(BangoEvent.objects.count(), 0)
+
+    @mock.patch('webpay.bango.events.executor')
+    def test_wait_for_slow_post(self, executor, slumber):
+        future = mock.Mock()
+        future.result.return_value = None
+        executor.submit.return_value = future
+        events.add('<xml/>')
+        eq_(events.forward(), 1)
+        # The post is waited for however long it takes.
+        future.result.assert_called_with()
+        eq_(BangoEvent.objects.count(), 0)
+
+    @mock.patch('webpay.bango.events.outbox.reschedule')
+    def test_release_unfinished(self, reschedule, slumber):
+        slumber.bango.event.post.side_effect = HttpServerError('500')
+        reschedule.side_effect = [ValueError, None, None]
+        for i in range(2):
+            events.add('<xml/>')
+        with self.assertRaises(ValueError):
+            events.forward()
+        # Both events are released once rescheduling the first fails.
+        eq_([c[0][1] for c in reschedule.call_args_list], [60, 0, 0])
@@ -1,5 +1,6 @@
 import base64
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
 
 import mock
@@ -7,6 +8,7 @@ from nose.tools import eq_
 from slumber.exceptions import HttpClientError
 from test_utils import TestCase
 
+from webpay.bango.models import BangoEvent
 from webpay.base.tests import BasicSessionCase
 
 
@@ -42,6 +44,11 @@ class TestBangoReturn(BasicSessionCase):
         self.call()
         payment_notify.delay.assert_called_with(self.trans_uuid)
 
+    @mock.patch('webpay.bango.views.forget_trans_status')
+    def test_status_forgotten(self, forget, payment_notify, slumber):
+        self.call()
+        forget.assert_called_with(self.trans_uuid)
+
     def test_invalid_return(self, payment_notify, slumber):
         err = HttpClientError
         err.content = ''
@@ -104,3 +111,29 @@ class TestNotification(TestCase):
         res = self.client.post(self.url, data={},
                                HTTP_AUTHORIZATION=self.auth)
         eq_(res.status_code, 200)
+
+    @mock.patch.object(settings, 'BANGO_EVENT_QUEUE', True)
+    @mock.patch.object(settings, 'BANGO_EVENT_USERNAME', 'u')
+    @mock.patch.object(settings, 'BANGO_EVENT_PASSWORD', 'p')
+    @mock.patch('webpay.bango.views.bango_tasks.forward_events')
+    @mock.patch('webpay.bango.views.client.slumber')
+    def test_post_queued(self, slumber, forward_events):
+        res = self.client.post(self.url, data='<xml/>',
+                               content_type='text/xml',
+                               HTTP_AUTHORIZATION=self.auth)
+        eq_(res.status_code, 200)
+        eq_(BangoEvent.objects.get().notification, '<xml/>')
+        assert forward_events.delay.called
+        assert not slumber.bango.event.post.called
+
+    @mock.patch.object(settings, 'BANGO_EVENT_QUEUE', True)
+    @mock.patch.object(settings, 'BANGO_EVENT_USERNAME', 'u')
+    @mock.patch.object(settings, 'BANGO_EVENT_PASSWORD', 'nope')
+    @mock.patch('webpay.bango.views.bango_tasks.forward_events')
+    def test_post_queued_bad_auth(self, forward_events):
+        res = self.client.post(self.url, data='<xml/>',
+                               content_type='text/xml',
+                               HTTP_AUTHORIZATION=self.auth)
+        eq_(res.status_code, 403)
+        eq_(BangoEvent.objects.count(), 0)
+        assert not forward_events.delay.called
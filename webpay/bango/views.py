@@ -1,5 +1,8 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 
 from django_paranoia.decorators import require_GET, require_POST
@@ -7,10 +10,12 @@ from slumber.exceptions import HttpClientError
 from tower import ugettext as _
 
 from lib.solitude.api import client
+from webpay.bango import events, tasks as bango_tasks
 from webpay.bango.auth import basic
 from webpay.base.logger import getLogger
 from webpay.base.utils import _error
 from webpay.pay import tasks
+from webpay.pay.utils import forget_trans_status
 
 log = getLogger('w.bango')
 
@@ -49,6 +54,8 @@ def _record(request):
                  'failed: %s' % (trans_uuid, err))
         return False
 
+    # The transaction is no longer waiting to start.
+    forget_trans_status(trans_uuid)
     return True
 
 
@@ -116,6 +123,9 @@ def notification(request):
     An end point for Bango to communicate with using the Event Notification
     API. This does the Basic Auth and then passes the whole thing on to do
     solitude.
+
+    With BANGO_EVENT_QUEUE on the event is saved and forwarded later
+    instead.
     """
     log.info('Bango notification received')
 
@@ -125,6 +135,27 @@ def notification(request):
         log.warning('Basic auth failed')
         return HttpResponseForbidden(request)
 
+    if settings.BANGO_EVENT_QUEUE:
+        # Solitude can't check the credentials when Bango sends them, so
+        # they are checked here and never saved.
+        if not (settings.BANGO_EVENT_USERNAME and
+                constant_time_compare(username,
+                                      settings.BANGO_EVENT_USERNAME) and
+                constant_time_compare(password,
+                                      settings.BANGO_EVENT_PASSWORD)):
+            log.warning('Basic auth failed for queued event')
+            return HttpResponseForbidden(request)
+        events.add(request.raw_post_data)
+        if cache.add(events.FORWARD_LOCK, True,
+                     settings.BANGO_EVENT_CLAIM_TIMEOUT):
+            try:
+                bango_tasks.forward_events.delay()
+            except Exception:
+                # The event is saved so cron will forward it instead.
+                log.exception('while queueing forward_events')
+                cache.delete(events.FORWARD_LOCK)
+        return HttpResponse(content='OK')
+
     try:
         # Just take the whole request and stuff into JSON for passing down
         # the pipe.
@@ -0,0 +1,125 @@
+"""
+Writes CEF records from a background thread.
+
+A CEF record is logged on every request so log_cef() only formats the
+record and puts it on a bounded queue. A writer thread takes records off
+the queue in batches and writes them to syslog or CEF_FILE. When the
+queue is full new records are dropped and counted instead of slowing
+down requests.
+"""
+import atexit
+import functools
+import os
+import Queue
+import threading
+
+from django.conf import settings
+
+# These are the helpers cef.log_cef() uses, which formats and writes in
+# one go.
+from cef import _filter_params, _format_msg, _get_fields, _log_lock, _syslog
+from django_statsd.clients import statsd
+
+from webpay.base.logger import getLogger
+
+log = getLogger('w.cef')
+
+# The only parts of request.META that go into a CEF record.
+META_KEYS = ('HTTP_X_FORWARDED_FOR', 'REMOTE_ADDR', 'REQUEST_METHOD',
+             'PATH_INFO', 'HTTP_HOST', 'HTTP_USER_AGENT')
+
+
+class CEFWriter(object):
+    """
+    Queues CEF records and writes them from a thread.
+
+    The thread is started lazily in each process so that forked workers
+    get their own.
+    """
+
+    def __init__(self):
+        g = functools.partial(getattr, settings)
+        self.severity = g('CEF_DEFAULT_SEVERITY', 5)
+        self.config = _filter_params('cef', {
+            'cef.product': 'WebPay',
+            'cef.vendor': g('CEF_VENDOR', 'Mozilla'),
+            'cef.version': g('CEF_VERSION', '0'),
+            'cef.device_version': g('CEF_DEVICE_VERSION', '0'),
+            'cef.file': g('CEF_FILE', 'syslog'),
+        })
+        self.queue_size = g('CEF_QUEUE_SIZE', 10000)
+        self.batch_size = g('CEF_BATCH_SIZE', 100)
+        self.dropped = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self.queue_size)
+            thread = threading.Thread(target=self._work, args=(self._queue,))
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def format(self, msg, request, severity=None):
+        environ = dict((k, request.META[k]) for k in META_KEYS
+                       if k in request.META)
+        if severity is None:
+            severity = self.severity
+        fields = _get_fields(msg, severity, environ,
+                             self.config, username='none',
+                             signature=request.get_full_path(), msg=msg)
+        return _format_msg(fields, {'msg': msg})
+
+    def log(self, msg, request, severity=None):
+        """Formats a CEF record about the request and queues it."""
+        record = self.format(msg, request, severity=severity)
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            statsd.incr('cef.dropped')
+
+    def _work(self, queue):
+        while True:
+            records = [queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self.write(records)
+
+    def write(self, records):
+        try:
+            if self.config['file'] == 'syslog':
+                for record in records:
+                    _syslog(record, self.config)
+            else:
+                with _log_lock:
+                    with open(self.config['file'], 'a') as f:
+                        f.write(''.join('%s\n' % r for r in records))
+        except Exception:
+            log.exception('while writing %s CEF records' % len(records))
+        statsd.incr('cef.written', len(records))
+
+    def flush(self):
+        """Writes any queued records from the calling thread."""
+        if self._pid != os.getpid():
+            return
+        records = []
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        if records:
+            self.write(records)
+
+
+writer = CEFWriter()
+atexit.register(writer.flush)
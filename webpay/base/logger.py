@@ -1,6 +1,11 @@
+import atexit
 import logging
+import os
+import Queue
 import threading
 
+from django.utils.importlib import import_module
+
 _local = threading.local()
 
 
@@ -12,6 +17,65 @@ def get_transaction_id():
     return getattr(_local, 'TRANSACTION_ID', None)
 
 
+def set_transaction_id(transaction_id):
+    _local.TRANSACTION_ID = transaction_id
+
+
+class Calls(object):
+    """
+    Adds up the outbound calls made while serving a request.
+
+    services is a dictionary of service name, such as 'solitude' or 'db',
+    to a [count, milliseconds] list. resources is the same for each
+    resource called, such as 'http.solitude.generic.buyer.get'.
+    """
+
+    def __init__(self):
+        self.services = {}
+        self.resources = {}
+        self._lock = threading.Lock()
+
+    def add(self, service, ms, resource=None):
+        # Calls run by executor threads add to the same totals.
+        with self._lock:
+            for totals, key in ((self.services, service),
+                                (self.resources, resource)):
+                if key is not None:
+                    total = totals.setdefault(key, [0, 0])
+                    total[0] += 1
+                    total[1] += ms
+
+
+def start_calls():
+    """Starts adding up the outbound calls made for the current request."""
+    _local.CALLS = Calls()
+
+
+def get_calls():
+    return getattr(_local, 'CALLS', None)
+
+
+def set_calls(calls):
+    _local.CALLS = calls
+
+
+def end_calls():
+    """
+    Stops adding up outbound calls and returns their Calls, or None if
+    start_calls() wasn't called.
+    """
+    calls = get_calls()
+    _local.CALLS = None
+    return calls
+
+
+def record_call(service, ms, resource=None):
+    """Adds a call to a service to the totals for the current request."""
+    calls = get_calls()
+    if calls is not None:
+        calls.add(service, ms, resource)
+
+
 def getLogger(name=None):
     logger = logging.getLogger(name)
     return WebpayAdapter(logger)
@@ -21,6 +85,10 @@ def getLogger(name=None):
 class WebpayAdapter(logging.LoggerAdapter):
     """
     Adds user, transaction id, remote_addr to every logging message's kwargs.
+
+    Pass message arguments separately, as in log.info('got %s', thing),
+    rather than formatting them with % so that nothing is formatted when
+    the level is disabled. A QueueHandler formats them in its own thread.
     """
 
     def __init__(self, logger, extra=None):
@@ -45,3 +113,93 @@ class LoggerMiddleware(object):
     def process_request(self, request):
         _local.TRANSACTION_ID = request.session.get('trans_id', '-')
         _local.REMOTE_ADDR = request.META.get('REMOTE_ADDR', '')
+
+
+def _build_handler(config):
+    config = dict(config)
+    klass = config.pop('class')
+    if isinstance(klass, basestring):
+        module, name = klass.rsplit('.', 1)
+        klass = getattr(import_module(module), name)
+    return klass(**dict((str(k), v) for k, v in config.items()))
+
+
+class QueueListener(object):
+    """
+    Passes records from a queue to a handler in a thread.
+
+    The thread is started lazily in each process so that forked workers
+    get their own.
+    """
+    _sentinel = None
+
+    def __init__(self, handler, queue_size):
+        self.handler = handler
+        self.queue_size = queue_size
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = Queue.Queue(self.queue_size)
+            self._thread = threading.Thread(target=self._monitor,
+                                            args=(self.queue,))
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _monitor(self, queue):
+        while True:
+            record = queue.get()
+            if record is self._sentinel:
+                return
+            self.handle(record)
+
+    def handle(self, record):
+        if record.levelno >= self.handler.level:
+            self.handler.handle(record)
+
+    def stop(self):
+        """Waits for queued records to be handled and stops the thread."""
+        if self._pid != os.getpid():
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._pid = None
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands records to a QueueListener so that formatting them and writing
+    them, such as to syslog or Sentry, happens off the calling thread.
+
+    :param handler: the handler to write records with, or a dict with its
+                    class and arguments as in settings.LOGGING.
+    :param queue_size: most records waiting to be written. Any more are
+                       dropped and counted in dropped.
+
+    The REMOTE_ADDR and TRANSACTION_ID extras are set on records before
+    they are queued so they are kept.
+    """
+
+    def __init__(self, handler, queue_size=10000, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        if isinstance(handler, dict):
+            handler = _build_handler(handler)
+        self.listener = QueueListener(handler, queue_size)
+        self.dropped = 0
+        atexit.register(self.listener.stop)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.listener.handler.setFormatter(fmt)
+
+    def emit(self, record):
+        if self.listener._pid != os.getpid():
+            self.listener.start()
+        try:
+            self.listener.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
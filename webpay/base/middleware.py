@@ -1,14 +1,19 @@
 import json
 import sys
+import time
 import traceback
 
 from django.conf import settings
+from django.db import connections
+from django.db.backends.util import CursorWrapper
 from django.utils.cache import patch_vary_headers
 from django.utils.translation.trans_real import parse_accept_lang_header
 
 import tower
+from django_statsd.clients import statsd
 
-from webpay.base.logger import getLogger
+from lib.utils import LocalCache
+from webpay.base.logger import end_calls, getLogger, record_call, start_calls
 from webpay.base.utils import log_cef
 
 log = getLogger('w.middleware')
@@ -50,9 +55,26 @@ class LocaleMiddleware(object):
     """
     1. Search for the locale.
     2. Save it in the request.
+
+    Lookup tables are built from settings.LANGUAGE_URL_MAP once and the
+    locale found for each Accept-Language header or lang parameter is
+    kept in an LRU cache, since clients only send a few distinct values.
     """
     def __init__(self):
         self.locale_from_accept = False
+        LUM = settings.LANGUAGE_URL_MAP
+        # Supported locales by code and by prefix, such as en for en-US.
+        # Codes win over prefixes, then the first code with a prefix.
+        self.accept_langs = LUM.copy()
+        for k, v in LUM.items():
+            self.accept_langs.setdefault(k.split('-')[0], v)
+        # The lang parameter falls back to the first code with its prefix
+        # even when the prefix is a code too.
+        self.input_prefixes = {}
+        for k, v in LUM.items():
+            self.input_prefixes.setdefault(k.split('-', 1)[0], v)
+        self.accept_cache = LocalCache(size=settings.LOCALE_CACHE_SIZE)
+        self.input_cache = LocalCache(size=settings.LOCALE_CACHE_SIZE)
 
     def get_language(self, request):
         """
@@ -71,10 +93,14 @@ class LocaleMiddleware(object):
         """
         Given an Accept-Language header, return the best-matching language.
         """
-        LUM = settings.LANGUAGE_URL_MAP
-        langs = LUM.copy()
-        langs.update((k.split('-')[0], v) for k, v in LUM.items() if
-                      k.split('-')[0] not in langs)
+        best = self.accept_cache.get(accept_lang)
+        if best is None:
+            best = self._get_best_language(accept_lang)
+            self.accept_cache.set(accept_lang, best)
+        return best
+
+    def _get_best_language(self, accept_lang):
+        langs = self.accept_langs
         ranked = parse_accept_lang_header(accept_lang)
         for lang, _ in ranked:
             lang = lang.lower()
@@ -92,16 +118,16 @@ class LocaleMiddleware(object):
 
         When not supported, returns the default locale.
         """
-        if lang in settings.LANGUAGE_URL_MAP:
-            return settings.LANGUAGE_URL_MAP[lang]
-        else:
-            # en-xx -> en-US, en-GB, ...
-            supported = [settings.LANGUAGE_URL_MAP[x] for
-                         x in settings.LANGUAGE_URL_MAP if
-                         x.split('-', 1)[0] == lang.lower().split('-', 1)[0]]
-            if len(supported):
-                return supported[0]
-        return settings.LANGUAGE_CODE
+        locale = self.input_cache.get(lang)
+        if locale is None:
+            if lang in settings.LANGUAGE_URL_MAP:
+                locale = settings.LANGUAGE_URL_MAP[lang]
+            else:
+                # en-xx -> en-US, en-GB, ...
+                locale = self.input_prefixes.get(
+                    lang.lower().split('-', 1)[0], False)
+            self.input_cache.set(lang, locale)
+        return locale or settings.LANGUAGE_CODE
 
     def process_request(self, request):
         self.locale_from_accept = False
@@ -130,3 +156,75 @@ class CEFMiddleware(object):
     def process_exception(self, request, exception):
         # We'll log the exceptions too with more severity.
         log_cef(exception.__class__.__name__, request, severity=8)
+
+
+class TimedCursor(CursorWrapper):
+    """Adds each query to the outbound calls for the current request."""
+
+    def execute(self, sql, params=()):
+        self.set_dirty()
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            record_call('db', (time.time() - start) * 1000)
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            record_call('db', (time.time() - start) * 1000)
+
+
+def time_queries(connection):
+    """Makes a database connection time its queries with TimedCursor."""
+    if getattr(connection, 'timed_queries', False):
+        return
+    make_debug_cursor = connection.make_debug_cursor
+
+    def make_cursor(cursor):
+        if settings.DEBUG:
+            # Keep recording connection.queries.
+            cursor = make_debug_cursor(cursor)
+        return TimedCursor(cursor, connection)
+
+    connection.make_debug_cursor = make_cursor
+    connection.use_debug_cursor = True
+    connection.timed_queries = True
+
+
+class CallsMiddleware(object):
+    """
+    Adds up the Solitude, Marketplace, Persona and database calls made
+    while serving each request and logs them in one line, such as::
+
+        outbound calls for /mozpay/: db=4/2.1ms solitude=3/150.0ms ...
+
+    followed by the same for each resource called. When
+    settings.SERVER_TIMING is on they are also sent in a Server-Timing
+    header.
+    """
+
+    def process_request(self, request):
+        for connection in connections.all():
+            time_queries(connection)
+        start_calls()
+
+    def process_response(self, request, response):
+        calls = end_calls()
+        if not calls or not calls.services:
+            return response
+        for service, (count, ms) in calls.services.items():
+            statsd.timing('http.%s.per_request' % service, ms)
+        # The transaction id is added to this like any other message.
+        log.info('outbound calls for %s: %s', request.path, ' '.join(
+            '%s=%s/%.1fms' % (name, count, ms) for totals in
+            (calls.services, calls.resources)
+            for name, (count, ms) in sorted(totals.items())))
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = ', '.join(
+                '%s;dur=%.1f;desc="%s calls"' % (service, ms, count)
+                for service, (count, ms) in sorted(calls.services.items()))
+        return response
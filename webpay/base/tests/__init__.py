@@ -1,5 +1,19 @@
 from django import test
 from django.conf import settings
+from django.core.cache import get_cache
+
+import mock
+
+
+def local_cache(target):
+    """
+    Returns a patch of the cache at target, such as
+    'webpay.pay.utils.cache', with an empty local memory cache. The test
+    settings use a dummy cache that never keeps anything.
+    """
+    cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+    cache.clear()
+    return mock.patch(target, cache)
 
 
 class BasicSessionCase(test.TestCase):
@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+import mock
+from nose.tools import eq_
+
+from webpay.base.ceflog import CEFWriter
+
+
+class TestCEFWriter(TestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().get('/mozpay/', HTTP_HOST='webpay',
+                                            HTTP_COOKIE='secret=1')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def writer(self, **kw):
+        with self.settings(CEF_FILE=self.path, **kw):
+            return CEFWriter()
+
+    def test_format(self):
+        record = self.writer().format('webpay:request', self.request,
+                                      severity=8)
+        assert 'CEF:0|Mozilla|WebPay|0|/mozpay/|webpay:request|8|' in record
+        assert 'dhost=webpay' in record
+        assert 'secret' not in record
+
+    def test_batch_written(self):
+        writer = self.writer()
+        writer.write(['one', 'two'])
+        eq_(open(self.path).read(), 'one\ntwo\n')
+
+    @mock.patch('webpay.base.ceflog.CEFWriter._work')
+    def test_dropped(self, work):
+        writer = self.writer(CEF_QUEUE_SIZE=1)
+        writer.log('one', self.request)
+        writer.log('two', self.request)
+        eq_(writer.dropped, 1)
+        writer.flush()
+        eq_(len(open(self.path).read().splitlines()), 1)
@@ -0,0 +1,46 @@
+import logging
+import os
+import Queue
+
+from django.test import TestCase
+
+from nose.tools import eq_
+
+from webpay.base.logger import getLogger, QueueHandler, set_transaction_id
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestQueueHandler(TestCase):
+
+    def setUp(self):
+        self.handler = QueueHandler({'class': '%s.ListHandler' % __name__})
+        self.logger = logging.getLogger('w.test.queue')
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_handled_in_thread(self):
+        set_transaction_id('trans-id')
+        getLogger('w.test.queue').error('got %s', 'thing')
+        self.handler.listener.stop()
+        record, = self.handler.listener.handler.records
+        eq_(record.getMessage(), 'got thing')
+        eq_(record.TRANSACTION_ID, 'trans-id')
+
+    def test_dropped(self):
+        listener = self.handler.listener
+        # A full queue with no thread taking records off it.
+        listener.queue = Queue.Queue(1)
+        listener.queue.put(object())
+        listener._pid = os.getpid()
+        getLogger('w.test.queue').error('dropped')
+        eq_(self.handler.dropped, 1)
+        listener._pid = None
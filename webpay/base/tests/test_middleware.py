@@ -9,8 +9,10 @@ import fudge
 import mock
 from nose.tools import eq_
 
-from webpay.base.middleware import (CEFMiddleware, LocaleMiddleware,
-                                    LogJSONerror)
+from webpay.base.logger import get_calls, record_call
+from webpay.base.middleware import (CallsMiddleware, CEFMiddleware,
+                                    LocaleMiddleware, LogJSONerror)
+from webpay.pay.models import Issuer
 
 
 class TestLocaleMiddleware(TestCase):
@@ -73,6 +75,21 @@ class TestLocaleMiddleware(TestCase):
     def test_no_input(self):
         eq_(self.process()[0], settings.LANGUAGE_CODE)
 
+    @mock.patch('webpay.base.middleware.parse_accept_lang_header')
+    def test_accept_cached(self, parse):
+        parse.return_value = [('en-us', 1.0)]
+        loc = LocaleMiddleware()
+        eq_(loc.get_best_language('en-us'), 'en-US')
+        eq_(loc.get_best_language('en-us'), 'en-US')
+        eq_(parse.call_count, 1)
+
+    def test_not_supported_cached(self):
+        loc = LocaleMiddleware()
+        eq_(loc.get_best_language('foo'), False)
+        eq_(loc.accept_cache.get('foo'), False)
+        with self.settings(LANGUAGE_CODE='de'):
+            eq_(loc.find_from_input('xx'), 'de')
+
 
 class ExcWithContent(Exception):
 
@@ -104,3 +121,39 @@ class TestCEFMiddleware(TestCase):
         exc = ExcWithContent('msg', 'foo')
         CEFMiddleware().process_exception(None, exc)
         log_cef.assert_called_with('ExcWithContent', None, severity=8)
+
+
+@mock.patch('webpay.base.middleware.statsd')
+class TestCallsMiddleware(TestCase):
+
+    def setUp(self):
+        self.middleware = CallsMiddleware()
+        self.request = RequestFactory().get('/mozpay/')
+        self.middleware.process_request(self.request)
+
+    def test_totals(self, statsd):
+        record_call('solitude', 10, 'http.solitude.generic.buyer.get')
+        record_call('solitude', 20, 'http.solitude.generic.buyer.get')
+        Issuer.objects.count()
+        calls = get_calls()
+        eq_(calls.services['solitude'], [2, 30])
+        eq_(calls.resources['http.solitude.generic.buyer.get'][0], 2)
+        eq_(calls.services['db'][0], 1)
+        res = self.middleware.process_response(self.request,
+                                               http.HttpResponse())
+        statsd.timing.assert_any_call('http.solitude.per_request', 30)
+        assert 'Server-Timing' not in res
+        eq_(get_calls(), None)
+
+    def test_server_timing(self, statsd):
+        record_call('persona', 5)
+        with self.settings(SERVER_TIMING=True):
+            res = self.middleware.process_response(self.request,
+                                                   http.HttpResponse())
+        eq_(res['Server-Timing'], 'persona;dur=5.0;desc="1 calls"')
+
+    def test_no_calls(self, statsd):
+        res = self.middleware.process_response(self.request,
+                                               http.HttpResponse())
+        assert 'Server-Timing' not in res
+        assert not statsd.timing.called
@@ -1,31 +1,21 @@
-import functools
-
 from django.conf import settings
 from django.shortcuts import render
 
-from cef import log_cef as _log_cef
 from tower import ugettext as _
 
+from webpay.base.ceflog import writer
 from webpay.base.logger import getLogger
 
 log = getLogger('w.pay')
 
 
 def log_cef(msg, request, **kw):
-    g = functools.partial(getattr, settings)
-    severity = kw.get('severity', g('CEF_DEFAULT_SEVERITY', 5))
-    cef_kw = {
-        'msg': msg,
-        'signature': request.get_full_path(),
-        'config': {
-            'cef.product': 'WebPay',
-            'cef.vendor': g('CEF_VENDOR', 'Mozilla'),
-            'cef.version': g('CEF_VERSION', '0'),
-            'cef.device_version': g('CEF_DEVICE_VERSION', '0'),
-            'cef.file': g('CEF_FILE', 'syslog'),
-        },
-    }
-    _log_cef(msg, severity, request.META.copy(), **cef_kw)
+    """
+    Logs a CEF record about the request.
+
+    The record is written in the background by webpay.base.ceflog.
+    """
+    writer.log(msg, request, severity=kw.get('severity'))
 
 
 def _error(request, msg='', exception=None, display=False):
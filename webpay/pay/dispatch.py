@@ -0,0 +1,155 @@
+"""
+Delivers many app notices at once.
+
+Notices are grouped by the host they are posted to. Each host gets up to
+NOTICE_HOST_CONCURRENCY deliveries at a time over the pooled postback
+connections so a slow app only holds up its own notices. Notices to a
+host that HostHealth says is failing are skipped rather than waiting on
+more timeouts.
+"""
+import logging
+import Queue
+import threading
+from urlparse import urlparse
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+
+from lib.utils import Executor
+
+from .models import Notice, NOT_SIMULATED
+from .utils import HostHealth, post_notice
+
+log = logging.getLogger('w.pay.dispatch')
+
+# Deliveries run in their own threads so that a batch can't use up the
+# threads needed for Solitude and Marketplace calls.
+executor = Executor(settings.NOTICE_WORKERS)
+
+
+class PendingNotice(object):
+    """A signed notice that is ready to be posted to an app."""
+
+    def __init__(self, url, signed_notice, trans_id, notice_type,
+                 simulated=NOT_SIMULATED):
+        self.url = url
+        self.signed_notice = signed_notice
+        self.trans_id = trans_id
+        self.notice_type = notice_type
+        self.simulated = simulated
+
+    @property
+    def host(self):
+        return urlparse(self.url).netloc
+
+    def __repr__(self):
+        return '<PendingNotice %s to %s>' % (self.trans_id, self.url)
+
+
+class NoticeResult(object):
+    """
+    The outcome of delivering a notice.
+
+    retry is True when the app could not be reached, or was skipped, and
+    the notice should be sent again later. attempted is False for
+    skipped notices.
+    """
+
+    def __init__(self, notice, success, last_error='', retry=False,
+                 attempted=True):
+        self.notice = notice
+        self.success = success
+        self.last_error = last_error
+        self.retry = retry
+        self.attempted = attempted
+
+
+class _Host(object):
+    """Delivery state for one host during a batch."""
+
+    def __init__(self, name, notices):
+        self.name = name
+        self.health = HostHealth(name)
+        self.queue = Queue.Queue()
+        for notice in notices:
+            self.queue.put(notice)
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def record(self, failed):
+        self.health.record(not failed)
+        with self.lock:
+            if failed:
+                self.failures += 1
+            else:
+                self.failures = 0
+
+    @property
+    def is_failing(self):
+        # The batch's own count stops it early even if the shared state
+        # can't be read.
+        return (self.failures >= settings.NOTICE_HOST_FAILURES or
+                not self.health.allow())
+
+
+class Dispatcher(object):
+    """
+    Sends batches of PendingNotice objects.
+
+    :param per_host: deliveries to run at the same time for each host,
+                     defaults to settings.NOTICE_HOST_CONCURRENCY.
+    """
+
+    def __init__(self, per_host=None):
+        self.per_host = per_host or settings.NOTICE_HOST_CONCURRENCY
+
+    def send(self, notices):
+        """
+        Delivers the notices and returns a list of NoticeResult objects.
+        """
+        by_host = {}
+        for notice in notices:
+            by_host.setdefault(notice.host, []).append(notice)
+
+        results = []
+        futures = []
+        for name, host_notices in by_host.iteritems():
+            host = _Host(name, host_notices)
+            for i in range(min(self.per_host, len(host_notices))):
+                futures.append(executor.submit(
+                    lambda host=host: self._drain(host, results)))
+        for future in futures:
+            future.result()
+        statsd.incr('notices.dispatch.sent', len(results))
+        return results
+
+    def _drain(self, host, results):
+        while True:
+            try:
+                notice = host.queue.get_nowait()
+            except Queue.Empty:
+                return
+            if host.is_failing:
+                statsd.incr('notices.dispatch.skipped')
+                results.append(NoticeResult(
+                    notice, False, retry=True, attempted=False,
+                    last_error='Skipped: %s is failing' % host.name))
+                continue
+            success, last_error, exception = post_notice(
+                notice.url, notice.signed_notice, notice.trans_id)
+            host.record(exception is not None)
+            results.append(NoticeResult(notice, success, last_error,
+                                        retry=exception is not None))
+
+
+def record_notices(results):
+    """Saves the results of a batch to the Notice table in one query."""
+    max_length = Notice._meta.get_field_by_name('last_error')[0].max_length
+    Notice.objects.bulk_create([
+        Notice(transaction_uuid=r.notice.trans_id,
+               success=r.success,
+               url=r.notice.url,
+               simulated=r.notice.simulated,
+               last_error=r.last_error[:max_length])
+        for r in results])
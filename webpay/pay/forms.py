@@ -3,7 +3,7 @@ from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
 from django_paranoia.forms import ParanoidForm
-import jwt
+from jwt import DecodeError
 from tower import ugettext as _
 
 from lib.solitude.api import client
@@ -11,6 +11,8 @@ from lib.solitude.constants import ACCESS_SIMULATE
 
 from webpay.base.logger import getLogger
 
+from .verify import ParsedJWT
+
 log = getLogger('w.pay')
 
 
@@ -19,24 +21,27 @@ class VerifyForm(ParanoidForm):
     key = settings.KEY
     secret = settings.SECRET
     is_simulation = False
+    # The decoded JWT, which process_pay_req() verifies with the secret.
+    jwt = None
 
     def clean_req(self):
         data = self.cleaned_data['req']
         jwt_data = data.encode('ascii', 'ignore')
-        log.debug('incoming JWT data: %r' % jwt_data)
+        log.debug('incoming JWT data: %r', jwt_data)
         try:
-            payload = jwt.decode(jwt_data, verify=False)
-        except jwt.DecodeError, exc:
+            self.jwt = ParsedJWT(jwt_data)
+        except DecodeError, exc:
             # L10n: first argument is a detailed error message.
             err = _('Error decoding JWT: {0}').format(exc)
             raise forms.ValidationError(err)
-        log.debug('Received JWT: %r' % payload)
+        payload = self.jwt.payload
+        log.debug('Received JWT: %r', payload)
         if not isinstance(payload, dict):
             # It seems that some JWT libs are encoding strings of JSON
             # objects, not actual objects. For now we treat this as an
             # error. If it becomes a headache for developers we can make a
             # guess and check the string for a JSON object.
-            log.info('JWT was not a dict, it was %r' % type(payload))
+            log.info('JWT was not a dict, it was %r', type(payload))
             raise forms.ValidationError(
                 # L10n: first argument is a data type, such as <unicode>
                 _('The JWT did not decode to a JSON object. Its type was {0}.')
@@ -68,10 +73,10 @@ class VerifyForm(ParanoidForm):
         else:
             try:
                 # Assuming that the app_id is also going to be the public_id.
-                prod = client.get_active_product(app_id)
+                prod = client.get_issuer(app_id)
             except ObjectDoesNotExist, err:
-                log.info('client.get_active_product(%r) raised %s: %s' %
-                         (app_id, err.__class__.__name__, err))
+                log.info('client.get_issuer(%r) raised %s: %s',
+                         app_id, err.__class__.__name__, err)
                 raise forms.ValidationError(
                     # L10n: the first argument is a key to identify an issuer.
                     _('No one has been registered for JWT issuer {0}.')
@@ -0,0 +1,20 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from webpay.pay.models import TaskArg
+
+
+class Command(BaseCommand):
+    help = ('Remove task arguments older than settings.TASK_ARG_TIMEOUT '
+            'that were never forgotten, such as for tasks that failed. '
+            'This is meant to be run from cron.')
+
+    def handle(self, *args, **options):
+        expired = TaskArg.objects.filter(
+            created__lt=datetime.now() -
+                        timedelta(seconds=settings.TASK_ARG_TIMEOUT))
+        count = expired.count()
+        expired.delete()
+        self.stdout.write('Removed %s task arguments\n' % count)
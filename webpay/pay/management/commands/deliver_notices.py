@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from webpay.pay import outbox
+from webpay.pay.tasks import deliver_outbox
+
+
+class Command(BaseCommand):
+    help = ('Send notices from the outbox that are due, in batches, until '
+            'none are left. This is meant to be run from cron.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int',
+                    help='Notices to claim at a time. Default is '
+                         'settings.NOTICE_OUTBOX_BATCH.'),
+    )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            rows = outbox.claim(options['batch'])
+            if not rows:
+                break
+            deliver_outbox(rows)
+            total += len(rows)
+        self.stdout.write('Claimed %s notices from the outbox\n' % total)
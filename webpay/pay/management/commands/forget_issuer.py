@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from lib.solitude.api import client
+
+
+class Command(BaseCommand):
+    args = '<issuer_key issuer_key ...>'
+    help = ('Remove JWT issuers from the cache, such as after their '
+            'secret was changed.')
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('At least one issuer key is required.')
+        for issuer_key in args:
+            client.forget_issuer(issuer_key)
+            self.stdout.write('Forgot issuer %s\n' % issuer_key)
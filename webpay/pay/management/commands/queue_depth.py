@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from celery import current_app
+from django_statsd.clients import statsd
+
+from webpay.pay.queues import queues
+
+
+class Command(BaseCommand):
+    help = ('Send the number of tasks waiting in each celery queue to '
+            'statsd. This is meant to be run from cron.')
+
+    def handle(self, *args, **options):
+        with current_app.connection() as conn:
+            for queue in queues():
+                # A queue that no worker has consumed from yet doesn't exist
+                # and that closes the channel, so each gets its own.
+                channel = conn.channel()
+                try:
+                    name, depth, consumers = channel.queue_declare(
+                        queue=queue, passive=True)
+                except conn.channel_errors:
+                    self.stdout.write('%s: not declared\n' % queue)
+                    continue
+                finally:
+                    channel.close()
+                statsd.gauge('celery.%s.depth' % queue, depth)
+                statsd.gauge('celery.%s.consumers' % queue, consumers)
+                self.stdout.write('%s: %s waiting, %s consumers\n'
+                                  % (queue, depth, consumers))
@@ -119,3 +119,42 @@ class Notice(models.Model):
 
     class Meta:
         db_table = 'notices'
+
+
+class OutboxNotice(models.Model):
+    """
+    A payment or chargeback notice waiting to be sent to an app.
+
+    Rows are claimed by pushing next_attempt forward and setting claim,
+    so a row whose dispatcher died becomes due again. A row is deleted
+    once its notice was delivered or given up on. Every attempt is
+    recorded in the Notice table.
+    """
+    transaction_uuid = models.CharField(max_length=255)
+    notice_type = models.IntegerField()
+    # For chargebacks, either 'reversal' or 'refund'.
+    reason = models.CharField(max_length=255, blank=True, default='')
+    attempts = models.IntegerField(default=0)
+    # Times the notice was held back because its app server was failing.
+    held = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    claim = models.CharField(max_length=32, null=True, blank=True,
+                             db_index=True)
+    last_error = models.CharField(max_length=255, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'notice_outbox'
+
+
+class TaskArg(models.Model):
+    """
+    A large task argument queued by reference. It is also kept in the
+    cache, and this copy is only read if the cache lost it.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    value = models.TextField()  # JSON.
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'task_args'
@@ -0,0 +1,94 @@
+"""
+The outbox of payment and chargeback notices.
+
+When settings.NOTICE_OUTBOX is on, payment_notify and chargeback_notify
+write each notice to the outbox and try to send it straight away.
+Notices that couldn't be delivered stay in the outbox until they are due
+again, when the deliver_notices command claims them in batches. Retries
+then wait in the database rather than in the broker.
+"""
+from datetime import datetime, timedelta
+import uuid
+
+from django.conf import settings
+
+from .models import OutboxNotice
+
+
+def _claim_until(now, timeout=None):
+    return now + timedelta(seconds=timeout or
+                           settings.NOTICE_OUTBOX_CLAIM_TIMEOUT)
+
+
+def add(transaction_uuid, notice_type, reason='', attempts=0, held=0,
+        delay=0, claimed=False):
+    """
+    Adds a notice to the outbox and returns its row.
+
+    :param delay: seconds until the notice is due.
+    :param claimed: if True the row is claimed for the caller to send.
+    """
+    now = datetime.now()
+    row = OutboxNotice(transaction_uuid=transaction_uuid,
+                       notice_type=notice_type,
+                       reason=reason or '',
+                       attempts=attempts,
+                       held=held,
+                       next_attempt=now + timedelta(seconds=delay))
+    if claimed:
+        row.claim = uuid.uuid4().hex
+        row.next_attempt = _claim_until(now)
+    row.save()
+    return row
+
+
+def claim(batch_size=None, model=OutboxNotice, timeout=None):
+    """
+    Claims up to batch_size notices that are due and returns their rows.
+
+    Dispatchers running at the same time never get the same row. Rows
+    that aren't rescheduled or removed become due again after timeout
+    seconds, NOTICE_OUTBOX_CLAIM_TIMEOUT by default.
+
+    Other queues with the same attempts, next_attempt, claim and
+    last_error columns can pass their model.
+    """
+    batch_size = batch_size or settings.NOTICE_OUTBOX_BATCH
+    now = datetime.now()
+    due = list(model.objects.filter(next_attempt__lte=now)
+                            .order_by('next_attempt')
+                            .values_list('pk', flat=True)[:batch_size])
+    if not due:
+        return []
+    token = uuid.uuid4().hex
+    # Rows claimed by someone else since they were selected are no longer
+    # due, so they are left alone.
+    (model.objects.filter(pk__in=due, next_attempt__lte=now)
+                  .update(claim=token,
+                          next_attempt=_claim_until(now, timeout)))
+    return list(model.objects.filter(claim=token))
+
+
+def reschedule(row, delay, last_error):
+    """Releases a claimed row to be tried again in delay seconds."""
+    model = row.__class__
+    field = model._meta.get_field_by_name('last_error')[0]
+    last_error = (last_error or '')[:field.max_length]
+    extra = {}
+    if hasattr(row, 'held'):
+        # Only notices count the times they were held back.
+        extra['held'] = row.held
+    (model.objects.filter(pk=row.pk)
+                  .update(attempts=row.attempts,
+                          claim=None,
+                          last_error=last_error,
+                          next_attempt=(datetime.now() +
+                                        timedelta(seconds=delay)),
+                          **extra))
+
+
+def remove(rows):
+    """Removes rows whose notices were delivered or given up on."""
+    if rows:
+        (rows[0].__class__.objects.filter(pk__in=[r.pk for r in rows])
+                                  .delete())
@@ -0,0 +1,50 @@
+"""
+Queue metrics for the tasks routed by settings.CELERY_ROUTES.
+
+The time each task waits in its queue is sent to statsd as
+celery.<queue>.lag. Tasks queued with an eta, such as retries, are left
+out since they are meant to wait. The queue_depth command sends the
+number of waiting tasks.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from celery.signals import task_prerun, task_sent
+from django_statsd.clients import statsd
+
+
+def queue_for(task_name):
+    """Returns the name of the queue that a task is sent to."""
+    route = settings.CELERY_ROUTES.get(task_name, {})
+    return route.get('queue', getattr(settings, 'CELERY_DEFAULT_QUEUE',
+                                      'celery'))
+
+
+def queues():
+    """Returns the names of every queue that tasks are sent to."""
+    return sorted(set([queue_for(name) for name in settings.CELERY_ROUTES] +
+                      [queue_for(None)]))
+
+
+def sent_key(task_id):
+    return 'celery:sent:%s' % task_id
+
+
+@task_sent.connect
+def record_sent(sender=None, id=None, eta=None, **kw):
+    if eta or not id:
+        return
+    statsd.incr('celery.%s.sent' % queue_for(sender))
+    cache.set(sent_key(id), time.time(), settings.CELERY_LAG_TIMEOUT)
+
+
+@task_prerun.connect
+def record_lag(sender=None, task_id=None, **kw):
+    sent = cache.get(sent_key(task_id))
+    if sent is None:
+        return
+    cache.delete(sent_key(task_id))
+    statsd.timing('celery.%s.lag' % queue_for(sender.name),
+                  int((time.time() - sent) * 1000))
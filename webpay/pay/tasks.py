@@ -1,4 +1,5 @@
 import calendar
+import functools
 import json
 import logging
 import sys
@@ -11,22 +12,33 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.db import transaction
 
+from celery.signals import worker_ready
 from celeryutils import task
 import jwt
 from lib.marketplace.api import client as mkt_client
 from lib.solitude import constants
-from lib.solitude.api import client
+from lib.solitude.api import async_client, client
+from lib.utils import run_parallel
 from multidb.pinning import use_master
 
 from webpay.base.helpers import absolutify
 from webpay.constants import TYP_CHARGEBACK, TYP_POSTBACK
+from .dispatch import Dispatcher, PendingNotice, record_notices
+from . import outbox
+# Connects the queue lag signals in web and worker processes.
+from . import queues  # noqa
 from .models import (Notice, NOT_SIMULATED, SIMULATED_POSTBACK,
                      SIMULATED_CHARGEBACK)
-from .utils import send_pay_notice
+from .utils import (backoff, claim_configure, end_configure_lease,
+                    forget_task_arg, format_exception, HostHealth,
+                    load_task_arg, notify_failure,
+                    publish_trans_ready, release_configure, send_pay_notice,
+                    store_task_arg, take_configure_lease, wait_for_trans)
 
 log = logging.getLogger('w.pay.tasks')
 notify_kw = dict(default_retry_delay=15,  # seconds
-                 max_tries=5)
+                 # send_pay_notice decides when to give up.
+                 max_retries=None)
 
 
 class TransactionOutOfSync(Exception):
@@ -44,23 +56,37 @@ def configure_transaction(request):
         log.info('is_simulation: skipping configure payments step')
         return
 
+    if not claim_configure(request.session['trans_id']):
+        log.info('trans %s already queued: skipping configure payments '
+                 'step' % request.session['trans_id'])
+        return
+
     log.info('configuring payment in background')
-    start_pay.delay(request.session['trans_id'],
-                    request.session['notes'],
-                    request.session['uuid'])
+    try:
+        start_pay.delay(request.session['trans_id'],
+                        store_task_arg(request.session['notes']),
+                        request.session['uuid'])
+    except:
+        # Nothing was queued, such as when the broker is down, so let the
+        # next attempt queue it.
+        release_configure(request.session['trans_id'])
+        raise
 
 
 def get_secret(issuer_key):
     """Resolve the secret for this JWT."""
     if is_marketplace(issuer_key):
         return settings.SECRET
-    else:
+    try:
+        return client.get_issuer(issuer_key)['secret']
+    except ObjectDoesNotExist:
+        # Apps of sellers that are no longer active still get notices.
         return (client.slumber.generic.product
                       .get_object_or_404(public_id=issuer_key))['secret']
 
 
-def get_seller_uuid(issuer_key, product_data):
-    """Resolve the JWT into a seller uuid."""
+def get_seller(issuer_key, product_data):
+    """Resolve the JWT into a seller, including its bango account."""
     if is_marketplace(issuer_key):
         # The issuer of the JWT is Firefox Marketplace.
         # This is a special case where we need to find the
@@ -74,23 +100,47 @@ def get_seller_uuid(issuer_key, product_data):
                              % (settings.KEY, product_data))
         log.info('Using real seller_uuid %r for Marketplace %r '
                  'app payment' % (seller_uuid, settings.KEY))
-        return seller_uuid
+        return client.get_seller(seller_uuid)
 
     else:
         # The issuer of the JWT is the seller.
-        # Resolve this into the seller uuid.
-        #
-        # TODO: we can speed this up by having product return the full data.
-        product = (client.slumber.generic.product
-                         .get_object_or_404(public_id=issuer_key))
-        return (client.slumber.generic.seller(product['seller'].split('/')[-2])
-                      .get_object_or_404())['uuid']
+        # Resolve this into the seller.
+        return client.get_issuer_seller(issuer_key)
+
+
+def get_seller_product(issuer_key, request):
+    """
+    Resolve the JWT into a (seller, bango product URI) tuple.
+
+    The bango product is created if this is the first purchase of it.
+    """
+    seller = get_seller(issuer_key, request.get('productData', ''))
+    return seller, client.get_bango_product(seller, request['id'],
+                                            request['name'])
 
 
 def is_marketplace(issuer_key):
     return issuer_key == settings.KEY
 
 
+@worker_ready.connect
+def preload_prices(**kw):
+    """Load the price tier table before the first purchase needs it."""
+    if not settings.PRICE_CACHE_TIMEOUT:
+        return
+    try:
+        mkt_client.load_prices()
+    except Exception:
+        # Prices will be loaded on demand instead.
+        log.exception('while preloading price tiers')
+
+
+@task
+def refresh_prices(**kw):
+    """Reloads the cached price tier table when it is due."""
+    mkt_client.refresh_prices()
+
+
 @task
 @use_master
 @transaction.commit_on_success
@@ -100,10 +150,36 @@ def start_pay(transaction_uuid, notes, user_uuid, **kw):
 
     This puts the transaction in a state where it's
     ready to be fulfilled by Bango.
+
+    notes can be a reference from store_task_arg().
     """
+    # This task is fired from multiple locations. Only one job should
+    # configure the transaction at a time.
+    if not take_configure_lease(transaction_uuid):
+        log.info('trans %s is being configured by another job: skipping '
+                 'configure payments step' % transaction_uuid)
+        return
     try:
-        # This task is fired from multiple locations. This checks first to
-        # see if it already ran.
+        _start_pay(transaction_uuid, notes, user_uuid)
+    except:
+        # Let the buyer's next visit queue another attempt.
+        release_configure(transaction_uuid)
+        raise
+    finally:
+        end_configure_lease(transaction_uuid)
+    forget_task_arg(notes)
+
+
+def _start_pay(transaction_uuid, notes, user_uuid):
+    cached = wait_for_trans(transaction_uuid, 0)
+    if cached and cached['status'] == constants.STATUS_PENDING:
+        log.info('trans %s already configured: skipping configure '
+                 'payments step' % transaction_uuid)
+        return
+
+    trans_pk = None
+    try:
+        # Check whether it was already configured by an earlier job.
         trans = (client.slumber.generic.transaction
                  .get_object(uuid=transaction_uuid))
         if trans['status'] in (constants.STATUS_RECEIVED,
@@ -112,43 +188,50 @@ def start_pay(transaction_uuid, notes, user_uuid, **kw):
                      'skipping configure payments step' % (transaction_uuid,
                                                            trans['status']))
             return
+        trans_pk = trans['resource_pk']
     except ObjectDoesNotExist:
         pass
 
+    # Notes are only loaded once the job knows it has work to do.
+    notes = load_task_arg(notes)
     pay = notes['pay_request']
     try:
-        seller_uuid = get_seller_uuid(notes['issuer_key'],
-                                      pay['request'].get('productData', ''))
-        # Ask the marketplace for a valid price point.
-        prices = mkt_client.get_price(pay['request']['pricePoint'])
-        log.debug('pricePoint=%s prices=%s' % (pay['request']['pricePoint'],
-                                               prices['prices']))
-        try:
-            icon_url = (get_icon_url(pay['request'])
-                        if settings.USE_PRODUCT_ICONS else None)
-        except:
-            log.exception('Calling get_icon_url')
-            icon_url = None
-        log.info('icon URL for %s: %s' % (transaction_uuid, icon_url))
+        # None of these depend on each other so they run at the same time.
+        (seller, bango_product_uri), prices, icon_url = run_parallel(
+            functools.partial(get_seller_product, notes['issuer_key'],
+                              pay['request']),
+            # Ask the marketplace for a valid price point.
+            functools.partial(mkt_client.get_price,
+                              pay['request']['pricePoint']),
+            functools.partial(get_product_icon_url, pay['request']))
+        log.debug('pricePoint=%s prices=%s', pay['request']['pricePoint'],
+                  prices['prices'])
+        log.info('icon URL for %s: %s', transaction_uuid, icon_url)
         # Set up the product for sale.
         bill_id, seller_product = client.configure_product_for_billing(
             transaction_uuid,
-            seller_uuid,
+            seller['uuid'],
             pay['request']['id'],
             pay['request']['name'],  # app/product name
             absolutify(reverse('bango.success')),
             absolutify(reverse('bango.error')),
             prices['prices'],
             icon_url,
-            user_uuid
+            user_uuid,
+            seller=seller,
+            bango_product_uri=bango_product_uri
         )
-        trans_pk = client.slumber.generic.transaction.get_object(
-            uuid=transaction_uuid)['resource_pk']
+        if trans_pk is None:
+            # Configuring billing created the transaction.
+            trans_pk = client.slumber.generic.transaction.get_object(
+                uuid=transaction_uuid)['resource_pk']
         client.slumber.generic.transaction(trans_pk).patch({
             'notes': json.dumps(notes),
             'uid_pay': bill_id,
             'status': constants.STATUS_PENDING
         })
+        # Let buyers waiting in trans_start_url go to Bango straight away.
+        publish_trans_ready(transaction_uuid, bill_id)
     except Exception, exc:
         log.exception('while configuring for payment')
         etype, val, tb = sys.exc_info()
@@ -171,6 +254,10 @@ def payment_notify(transaction_uuid, **kw):
 
     trans_id: pk of Transaction
     """
+    if settings.NOTICE_OUTBOX:
+        deliver_outbox([outbox.add(transaction_uuid, constants.TYPE_PAYMENT,
+                                   claimed=True)])
+        return
     transaction = client.get_transaction(transaction_uuid)
     _notify(payment_notify, transaction)
 
@@ -187,11 +274,93 @@ def chargeback_notify(transaction_uuid, **kw):
     trans_id: pk of Transaction
     reason: either 'reversal' or 'refund'
     """
+    if settings.NOTICE_OUTBOX:
+        deliver_outbox([outbox.add(transaction_uuid, constants.TYPE_REFUND,
+                                   reason=kw.get('reason', ''),
+                                   claimed=True)])
+        return
     transaction = client.get_transaction(transaction_uuid)
     _notify(chargeback_notify, transaction,
             extra_response={'reason': kw.get('reason', '')})
 
 
+def deliver_outbox(rows):
+    """
+    Sends the notices of claimed outbox rows.
+
+    Transactions are fetched from Solitude at the same time and notices
+    are delivered by the dispatcher. Delivered notices are removed from
+    the outbox. The rest are rescheduled for when their app server is
+    expected to be back, until POSTBACK_ATTEMPTS tries have been made or
+    the notice has been held back POSTBACK_CIRCUIT_BUDGET times. A row
+    whose notice can't be built is rescheduled the same way, so one bad
+    row never holds up the rest.
+    """
+    deadline = time.time() + settings.PARALLEL_TIMEOUT
+    futures = [async_client.get_transaction(row.transaction_uuid)
+               for row in rows]
+    pending = {}
+    done = []
+    try:
+        for row, future in zip(rows, futures):
+            try:
+                trans = future.result(max(deadline - time.time(), 0))
+            except ValueError:
+                log.exception('Not notifying about transaction %s'
+                              % row.transaction_uuid)
+                done.append(row)
+                continue
+            except Exception, exc:
+                # Solitude is probably down; this doesn't use up a try.
+                log.exception('while fetching transaction %s'
+                              % row.transaction_uuid)
+                outbox.reschedule(row, settings.NOTICE_OUTBOX_CLAIM_TIMEOUT,
+                                  format_exception(exc))
+                continue
+            extra_response = None
+            if row.notice_type == constants.TYPE_REFUND:
+                extra_response = {'reason': row.reason}
+            try:
+                notice = _build_notice(trans, extra_response=extra_response)
+            except Exception, exc:
+                log.exception('while building a notice about transaction %s'
+                              % row.transaction_uuid)
+                row.attempts += 1
+                if row.attempts >= settings.POSTBACK_ATTEMPTS:
+                    done.append(row)
+                else:
+                    outbox.reschedule(row, backoff(row.attempts),
+                                      format_exception(exc))
+                continue
+            pending[notice] = row
+
+        results = Dispatcher().send(pending.keys())
+        record_notices([r for r in results if r.attempted])
+        for result in results:
+            row = pending[result.notice]
+            row.attempts += int(result.attempted)
+            row.held += int(not result.attempted)
+            if not result.retry:
+                done.append(row)
+                continue
+            try:
+                health = HostHealth(result.notice.host)
+                if (row.attempts >= settings.POSTBACK_ATTEMPTS or
+                    row.held >= settings.POSTBACK_CIRCUIT_BUDGET):
+                    done.append(row)
+                    notify_failure(result.notice.url, row.transaction_uuid)
+                    continue
+                outbox.reschedule(row, health.retry_delay(row.attempts),
+                                  result.last_error)
+            except Exception:
+                log.exception('while rescheduling transaction %s'
+                              % row.transaction_uuid)
+    finally:
+        # Rows that weren't removed or rescheduled are due again once
+        # their claim runs out.
+        outbox.remove(done)
+
+
 @task(**notify_kw)
 @use_master
 def simulate_notify(issuer_key, pay_request, trans_uuid=None, **kw):
@@ -199,8 +368,11 @@ def simulate_notify(issuer_key, pay_request, trans_uuid=None, **kw):
     Post JWT notice to an app about a simulated payment.
 
     This isn't really much different from a regular notice except
-    that a fake transaction_uuid is created.
+    that a fake transaction_uuid is created. pay_request can be a
+    reference from store_task_arg().
     """
+    pay_request_arg = pay_request
+    pay_request = load_task_arg(pay_request)
     if not trans_uuid:
         trans_uuid = 'simulate:%s' % uuid.uuid4()
     trans = {'uuid': trans_uuid,
@@ -220,9 +392,25 @@ def simulate_notify(issuer_key, pay_request, trans_uuid=None, **kw):
     else:
         raise NotImplementedError('Not sure how to simulate %s' % sim)
 
-    log.info('Sending simulate notice %s to %s' % (sim, issuer_key))
+    log.info('Sending simulate notice %s to %s', sim, issuer_key)
+    # Retries keep passing the reference rather than the pay request.
     _notify(simulate_notify, trans, extra_response=extra_response,
-            simulated=sim_flag, task_args=[issuer_key, pay_request])
+            simulated=sim_flag, task_args=[issuer_key, pay_request_arg])
+    forget_task_arg(pay_request_arg)
+
+
+def get_product_icon_url(request):
+    """
+    Like get_icon_url() but returns None when icons are disabled or
+    anything goes wrong.
+    """
+    if not settings.USE_PRODUCT_ICONS:
+        return None
+    try:
+        return get_icon_url(request)
+    except:
+        log.exception('Calling get_icon_url')
+        return None
 
 
 def get_icon_url(request):
@@ -268,11 +456,31 @@ def _notify(notifier_task, trans, extra_response=None, simulated=NOT_SIMULATED,
     Post JWT notice to an app server about a payment.
     """
     # TODO(Kumar) yell if transaction is not completed?
+    notice = _build_notice(trans, extra_response=extra_response,
+                           simulated=simulated)
+    if not task_args:
+        task_args = [trans['uuid']]
+
+    success, last_error = send_pay_notice(notice.url, trans['type'],
+                                          notice.signed_notice,
+                                          trans['uuid'], notifier_task,
+                                          task_args, simulated=simulated)
+    s = Notice._meta.get_field_by_name('last_error')[0].max_length
+    last_error = last_error[:s]  # truncate to fit
+    Notice.objects.create(transaction_uuid=trans['uuid'],
+                          success=success,
+                          url=notice.url,
+                          simulated=simulated,
+                          last_error=last_error)
+
+
+def _build_notice(trans, extra_response=None, simulated=NOT_SIMULATED):
+    """
+    Returns a PendingNotice with a signed JWT about the transaction.
+    """
     typ, url = _prepare_notice(trans)
     response = {'transactionID': trans['uuid']}
     notes = trans['notes']
-    if not task_args:
-        task_args = [trans['uuid']]
 
     if extra_response:
         response.update(extra_response)
@@ -285,20 +493,12 @@ def _notify(notifier_task, trans, extra_response=None, simulated=NOT_SIMULATED,
               'exp': issued_at + 3600,  # Expires in 1 hour
               'request': notes['pay_request']['request'],
               'response': response}
-    log.info('preparing notice %s' % notice)
+    log.info('preparing notice %s', notice)
 
     signed_notice = jwt.encode(notice, get_secret(notes['issuer_key']),
                                algorithm='HS256')
-    success, last_error = send_pay_notice(url, trans['type'], signed_notice,
-                                          trans['uuid'], notifier_task,
-                                          task_args, simulated=simulated)
-    s = Notice._meta.get_field_by_name('last_error')[0].max_length
-    last_error = last_error[:s]  # truncate to fit
-    Notice.objects.create(transaction_uuid=trans['uuid'],
-                          success=success,
-                          url=url,
-                          simulated=simulated,
-                          last_error=last_error)
+    return PendingNotice(url, signed_notice, trans['uuid'], trans['type'],
+                         simulated=simulated)
 
 
 def _prepare_notice(trans):
@@ -46,5 +46,6 @@ class Base(BasicSessionCase, JWTtester):
     def set_secret(self, get_active_product):
         get_active_product.return_value = {
             'secret': self.secret,
-            'access': constants.ACCESS_PURCHASE
+            'access': constants.ACCESS_PURCHASE,
+            'seller': '/generic/seller/1/'
         }
@@ -0,0 +1,54 @@
+from django import test
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_
+from requests.exceptions import Timeout
+
+from lib.solitude import constants
+from webpay.pay.dispatch import Dispatcher, PendingNotice, record_notices
+from webpay.pay.models import Notice
+
+
+def notice(url, trans_id='some:uuid'):
+    return PendingNotice(url, 'signed', trans_id, constants.TYPE_PAYMENT)
+
+
+@override_settings(NOTICE_HOST_FAILURES=2)
+@mock.patch('webpay.pay.dispatch.post_notice')
+class TestDispatcher(test.TestCase):
+
+    def test_send(self, post):
+        post.return_value = True, '', None
+        notices = [notice('http://a.com/post', 'a:%s' % i) for i in range(3)]
+        notices.append(notice('http://b.com/post', 'b:1'))
+        results = Dispatcher(per_host=2).send(notices)
+        eq_(sorted(r.notice.trans_id for r in results),
+            ['a:0', 'a:1', 'a:2', 'b:1'])
+        assert all(r.success and not r.retry for r in results)
+        eq_(post.call_count, 4)
+
+    def test_failing_host_skipped(self, post):
+        def fail_a(url, signed_notice, trans_id):
+            if url.startswith('http://a.com'):
+                return False, 'Timeout: ', Timeout()
+            return True, '', None
+        post.side_effect = fail_a
+        notices = [notice('http://a.com/post', 'a:%s' % i) for i in range(5)]
+        notices.append(notice('http://b.com/post', 'b:1'))
+        results = Dispatcher(per_host=1).send(notices)
+        eq_(post.call_count, 3)
+        eq_(len([r for r in results if r.retry]), 5)
+        eq_([r.notice.trans_id for r in results if r.success], ['b:1'])
+
+
+class TestRecordNotices(test.TestCase):
+
+    @mock.patch('webpay.pay.dispatch.post_notice')
+    def test_record(self, post):
+        post.return_value = False, 'x' * 300, Timeout()
+        record_notices(Dispatcher().send([notice('http://a.com/post')]))
+        saved = Notice.objects.get()
+        eq_(saved.transaction_uuid, 'some:uuid')
+        eq_(saved.success, False)
+        eq_(len(saved.last_error), 255)
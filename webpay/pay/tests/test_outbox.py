@@ -0,0 +1,157 @@
+from datetime import datetime, timedelta
+
+from django import test
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_
+from requests.exceptions import Timeout
+
+from lib.solitude import constants
+from webpay.base.tests import local_cache
+from webpay.pay import outbox, tasks
+from webpay.pay.models import Notice, OutboxNotice
+
+from .test_tasks import NotifyTest
+
+
+class TestClaim(test.TestCase):
+
+    def test_claim_due(self):
+        due = outbox.add('some:1', constants.TYPE_PAYMENT)
+        outbox.add('some:2', constants.TYPE_PAYMENT, delay=60)
+        outbox.add('some:3', constants.TYPE_PAYMENT, claimed=True)
+        eq_([r.pk for r in outbox.claim()], [due.pk])
+        # It is not claimed again until the claim runs out.
+        eq_(outbox.claim(), [])
+
+    def test_batch(self):
+        for i in range(3):
+            outbox.add('some:%s' % i, constants.TYPE_PAYMENT)
+        eq_(len(outbox.claim(2)), 2)
+        eq_(len(outbox.claim(2)), 1)
+
+    def test_reschedule(self):
+        outbox.add('some:1', constants.TYPE_PAYMENT)
+        row = outbox.claim()[0]
+        row.attempts = 1
+        outbox.reschedule(row, 0, 'Timeout: ')
+        row = outbox.claim()[0]
+        eq_(row.attempts, 1)
+        eq_(row.last_error, 'Timeout: ')
+
+
+@override_settings(NOTICE_OUTBOX=True, POSTBACK_ATTEMPTS=2)
+@mock.patch('webpay.pay.dispatch.post_notice')
+@mock.patch('lib.solitude.api.client.slumber')
+@mock.patch('lib.solitude.api.client.get_transaction')
+class TestDeliverOutbox(NotifyTest):
+
+    def setUp(self):
+        super(TestDeliverOutbox, self).setUp()
+        p = local_cache('webpay.pay.utils.cache')
+        p.start()
+        self.addCleanup(p.stop)
+
+    def transaction(self, uuid):
+        return {'status': constants.STATUS_COMPLETED,
+                'notes': {'pay_request': self.payload(),
+                          'issuer_key': 'k'},
+                'type': constants.TYPE_PAYMENT,
+                'uuid': uuid}
+
+    def test_delivered(self, get_transaction, slumber, post):
+        self.set_secret_mock(slumber, 'f')
+        get_transaction.side_effect = self.transaction
+        post.return_value = True, '', None
+        tasks.payment_notify('some:1')
+        eq_(OutboxNotice.objects.count(), 0)
+        eq_(Notice.objects.get().success, True)
+
+    def test_rescheduled(self, get_transaction, slumber, post):
+        self.set_secret_mock(slumber, 'f')
+        get_transaction.side_effect = self.transaction
+        post.return_value = False, 'Timeout: ', Timeout()
+        tasks.payment_notify('some:1')
+        row = OutboxNotice.objects.get()
+        eq_(row.attempts, 1)
+        assert row.next_attempt > datetime.now(), row.next_attempt
+        eq_(Notice.objects.get().success, False)
+
+    @mock.patch('webpay.pay.tasks.notify_failure')
+    def test_give_up(self, notify_failure, get_transaction, slumber, post):
+        self.set_secret_mock(slumber, 'f')
+        get_transaction.side_effect = self.transaction
+        post.return_value = False, 'Timeout: ', Timeout()
+        outbox.add('some:1', constants.TYPE_PAYMENT, attempts=1)
+        tasks.deliver_outbox(outbox.claim())
+        eq_(OutboxNotice.objects.count(), 0)
+        notify_failure.assert_called_with(mock.ANY, 'some:1')
+
+    @override_settings(POSTBACK_CIRCUIT_BUDGET=2)
+    @mock.patch('webpay.pay.utils.HostHealth.allow')
+    @mock.patch('webpay.pay.tasks.notify_failure')
+    def test_held_too_often(self, notify_failure, allow, get_transaction,
+                            slumber, post):
+        self.set_secret_mock(slumber, 'f')
+        get_transaction.side_effect = self.transaction
+        allow.return_value = False
+        outbox.add('some:1', constants.TYPE_PAYMENT)
+        tasks.deliver_outbox(outbox.claim())
+        eq_(OutboxNotice.objects.get().held, 1)
+        OutboxNotice.objects.update(next_attempt=datetime.now())
+        tasks.deliver_outbox(outbox.claim())
+        eq_(OutboxNotice.objects.count(), 0)
+        assert not post.called
+        notify_failure.assert_called_with(mock.ANY, 'some:1')
+
+    @override_settings(PARALLEL_TIMEOUT=30)
+    @mock.patch('webpay.pay.tasks.time')
+    @mock.patch('webpay.pay.tasks.async_client')
+    def test_fetch_deadline(self, async_client, time, get_transaction,
+                            slumber, post):
+        futures = [mock.Mock(), mock.Mock()]
+        for future in futures:
+            future.result.side_effect = ValueError
+        async_client.get_transaction.side_effect = futures
+        time.time.side_effect = [0, 10, 25]
+        outbox.add('some:1', constants.TYPE_PAYMENT)
+        outbox.add('some:2', constants.TYPE_PAYMENT)
+        tasks.deliver_outbox(outbox.claim())
+        # Both fetches share one deadline.
+        futures[0].result.assert_called_with(20)
+        futures[1].result.assert_called_with(5)
+
+    def test_missing_transaction(self, get_transaction, slumber, post):
+        get_transaction.side_effect = ValueError
+        outbox.add('some:1', constants.TYPE_PAYMENT)
+        tasks.deliver_outbox(outbox.claim())
+        eq_(OutboxNotice.objects.count(), 0)
+        assert not post.called
+
+    def test_solitude_down(self, get_transaction, slumber, post):
+        get_transaction.side_effect = Timeout
+        outbox.add('some:1', constants.TYPE_PAYMENT)
+        tasks.deliver_outbox(outbox.claim())
+        row = OutboxNotice.objects.get()
+        assert row.next_attempt > datetime.now() + timedelta(seconds=60)
+
+    def test_bad_row(self, get_transaction, slumber, post):
+        self.set_secret_mock(slumber, 'f')
+
+        def transaction(uuid):
+            trans = self.transaction(uuid)
+            if uuid == 'some:1':
+                trans['type'] = 'not a type'
+            return trans
+        get_transaction.side_effect = transaction
+        post.return_value = True, '', None
+        outbox.add('some:1', constants.TYPE_PAYMENT)
+        outbox.add('some:2', constants.TYPE_PAYMENT)
+        tasks.deliver_outbox(outbox.claim())
+        # The other notice is still sent and the bad row is rescheduled.
+        eq_(Notice.objects.get().transaction_uuid, 'some:2')
+        row = OutboxNotice.objects.get()
+        eq_((row.transaction_uuid, row.attempts, row.claim),
+            ('some:1', 1, None))
+        assert row.last_error.startswith('NotImplementedError'), row
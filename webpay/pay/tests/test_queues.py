@@ -0,0 +1,39 @@
+from django import test
+
+import mock
+from nose.tools import eq_
+
+from webpay.base.tests import local_cache
+from webpay.pay import queues
+
+
+class TestQueues(test.TestCase):
+
+    def setUp(self):
+        for p in (local_cache('webpay.pay.queues.cache'),
+                  mock.patch('webpay.pay.queues.statsd')):
+            self.statsd = p.start()
+            self.addCleanup(p.stop)
+
+    def test_routes(self):
+        eq_(queues.queue_for('webpay.pay.tasks.start_pay'),
+            'webpay.configure')
+        eq_(queues.queue_for('webpay.pay.tasks.payment_notify'),
+            'webpay.notices')
+        eq_(queues.queue_for('some.other.task'), 'celery')
+        eq_(queues.queues(), ['celery', 'webpay.configure', 'webpay.notices'])
+
+    def test_lag(self):
+        queues.record_sent(sender='webpay.pay.tasks.start_pay', id='x')
+        task = mock.Mock()
+        task.name = 'webpay.pay.tasks.start_pay'
+        queues.record_lag(sender=task, task_id='x')
+        eq_(self.statsd.timing.call_args[0][0], 'celery.webpay.configure.lag')
+
+    def test_no_lag_for_eta(self):
+        queues.record_sent(sender='webpay.pay.tasks.payment_notify', id='x',
+                           eta='2013-01-01T00:00:00')
+        task = mock.Mock()
+        task.name = 'webpay.pay.tasks.payment_notify'
+        queues.record_lag(sender=task, task_id='x')
+        assert not self.statsd.timing.called
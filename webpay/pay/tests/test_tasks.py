@@ -1,4 +1,5 @@
 import calendar
+import threading
 import time
 import urllib2
 
@@ -20,6 +21,7 @@ import test_utils
 from lib.marketplace.api import UnknownPricePoint
 from lib.solitude import api
 from lib.solitude import constants
+from webpay.base.tests import local_cache
 from webpay.constants import TYP_CHARGEBACK, TYP_POSTBACK
 from webpay.pay import tasks
 from webpay.pay.models import Notice, SIMULATED_POSTBACK, SIMULATED_CHARGEBACK
@@ -35,7 +37,9 @@ class NotifyTest(JWTtester, test.TestCase):
         self.trans_uuid = 'some:uuid'
 
     def set_secret_mock(self, slumber, s):
-        slumber.generic.product.get_object_or_404.return_value = {'secret': s}
+        slumber.generic.product.get_object.return_value = {
+            'secret': s, 'access': constants.ACCESS_PURCHASE,
+            'seller': '/generic/seller/1/'}
 
     def url(self, path, protocol='https'):
         return protocol + '://' + self.domain + path
@@ -67,7 +71,7 @@ class TestNotifyApp(NotifyTest):
         with self.settings(INAPP_KEY_PATHS={None: sample}, DEBUG=True):
             tasks.payment_notify('some:uuid')
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_pay(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -92,7 +96,7 @@ class TestNotifyApp(NotifyTest):
         eq_(notice.success, True)
         eq_(notice.url, url)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_refund_chargeback(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -119,7 +123,7 @@ class TestNotifyApp(NotifyTest):
         eq_(notice.success, True)
         eq_(notice.url, url)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_reversal_chargeback(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -141,7 +145,7 @@ class TestNotifyApp(NotifyTest):
         eq_(notice.last_error, '')
         eq_(notice.success, True)
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_notify_marketplace(self, marketplace, solitude, requests):
@@ -150,7 +154,7 @@ class TestNotifyApp(NotifyTest):
         self.notify()
         assert marketplace.webpay.failure.called
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_notify_timeout(self, marketplace, solitude, requests):
@@ -164,7 +168,7 @@ class TestNotifyApp(NotifyTest):
 
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.http.post')
     def test_retry_http_error(self, post, retry, slumber):
         self.set_secret_mock(slumber, 'f')
         post.side_effect = RequestException('500 error')
@@ -172,7 +176,7 @@ class TestNotifyApp(NotifyTest):
         assert post.called, 'notification not sent'
         assert retry.called, 'task was not retried after error'
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_any_error(self, fake_req, marketplace, solitude):
@@ -184,7 +188,7 @@ class TestNotifyApp(NotifyTest):
         er = notice.last_error
         assert 'some http error' in er, 'Unexpected: %s' % er
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_bad_status(self, fake_req, marketplace, solitude):
@@ -200,7 +204,7 @@ class TestNotifyApp(NotifyTest):
         er = notice.last_error
         assert 'HTTP Error' in er, 'Unexpected: %s' % er
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_invalid_app_response(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -212,7 +216,7 @@ class TestNotifyApp(NotifyTest):
         eq_(notice.success, False)
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.http')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
     def test_notify_retries(self, retry, requests, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -221,7 +225,7 @@ class TestNotifyApp(NotifyTest):
         assert retry.called, 'task was not retried after error'
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.http')
     @mock.patch('webpay.pay.utils.notify_failure')
     def test_failure_notifies(self, notify, requests, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -229,7 +233,7 @@ class TestNotifyApp(NotifyTest):
         self.notify()
         assert notify.called, 'notify called'
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_signed_app_response(self, fake_req, slumber):
         app_payment = self.payload()
@@ -275,7 +279,7 @@ class TestSimulatedNotifications(NotifyTest):
         tasks.simulate_notify('issuer-key', payload,
                               trans_uuid=self.trans_uuid)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     def test_postback(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         payload = self.payload(typ=TYP_POSTBACK,
@@ -301,7 +305,7 @@ class TestSimulatedNotifications(NotifyTest):
         eq_(notice.url, url)
         eq_(notice.simulated, SIMULATED_POSTBACK)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     def test_chargeback(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         req = {'simulate': {'result': 'chargeback'}}
@@ -328,7 +332,7 @@ class TestSimulatedNotifications(NotifyTest):
         eq_(notice.url, url)
         eq_(notice.simulated, SIMULATED_CHARGEBACK)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.http')
     def test_chargeback_reason(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         reason = 'something'
@@ -352,7 +356,7 @@ class TestSimulatedNotifications(NotifyTest):
         self.notify(payload)
 
     @mock.patch('webpay.pay.tasks.simulate_notify.retry')
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.http.post')
     def test_retry_http_error(self, post, retry, slumber):
         self.set_secret_mock(slumber, 'f')
         post.side_effect = RequestException('500 error')
@@ -365,9 +369,10 @@ class TestSimulatedNotifications(NotifyTest):
         assert post.called, 'notification not sent'
         assert retry.called, 'task was not retried after error'
         retry.assert_called_with(args=['issuer-key', payload],
+                                 kwargs={'attempts': 1},
                                  max_retries=ANY, eta=ANY, exc=ANY)
 
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.http.post')
     @mock.patch('webpay.pay.utils.notify_failure')
     def test_no_notifications_on_simulate(self, notify_failure, post, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -436,6 +441,32 @@ class TestStartPay(test_utils.TestCase):
         self.start()
         solitude.generic.transaction.assert_called_with(5)
 
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('lib.marketplace.api.client.api')
+    def test_create_bango_product(self, marketplace, solitude):
+        solitude.bango.product.get_object.side_effect = ObjectDoesNotExist
+        solitude.bango.product.post.return_value = {
+            'resource_uri': 'some:uri', 'bango_id': '5678'}
+        posts = []
+        all_sent = threading.Event()
+
+        def post(data):
+            posts.append(data)
+            if len(posts) == 3:
+                all_sent.set()
+            # This only returns straight away if the premium and rating
+            # POSTs are all sent at the same time.
+            all_sent.wait(5)
+
+        solitude.bango.premium.post.side_effect = post
+        solitude.bango.rating.post.side_effect = post
+        self.start()
+        assert all_sent.isSet()
+        eq_(solitude.generic.product.post.call_args[0][0]['external_id'],
+            'generated-product-uuid')
+        eq_(solitude.bango.rating.post.call_count, 2)
+        eq_(solitude.bango.premium.post.call_count, 1)
+
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_price_used(self, marketplace, solitude):
@@ -510,6 +541,63 @@ class TestStartPay(test_utils.TestCase):
         solitude.generic.seller.get_object.assert_called_with(
             uuid=app_seller_uuid)
 
+    @mock.patch.object(settings, 'KEY', 'marketplace-domain')
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('lib.marketplace.api.client.api')
+    def test_seller_fetched_once(self, marketplace, solitude):
+        self.notes['issuer_key'] = 'marketplace-domain'
+        self.notes['pay_request']['request']['productData'] = (
+            'seller_uuid=some-seller-uuid')
+        self.start()
+        eq_(solitude.generic.seller.get_object.call_count, 1)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('lib.marketplace.api.client.api')
+    def test_transaction_fetched_once(self, marketplace, solitude):
+        solitude.generic.transaction.get_object.return_value = {
+            'status': 'not-pending',
+            'resource_pk': 5}
+        self.start()
+        eq_(solitude.generic.transaction.get_object.call_count, 1)
+        solitude.generic.transaction.assert_called_with(5)
+
+    @mock.patch('webpay.pay.tasks.publish_trans_ready')
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('lib.marketplace.api.client.api')
+    def test_ready_published(self, marketplace, solitude, publish):
+        solitude.generic.transaction.get_object.return_value = {
+            'status': 'not-pending',
+            'resource_pk': 5}
+        self.set_billing_id(solitude, 123)
+        self.start()
+        publish.assert_called_with(self.transaction_uuid, 123)
+
+    @mock.patch('webpay.pay.tasks.take_configure_lease')
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_leased_elsewhere(self, solitude, lease):
+        lease.return_value = False
+        self.start()
+        assert not solitude.generic.transaction.get_object.called
+
+    @mock.patch('webpay.pay.tasks.wait_for_trans')
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_cached_pending(self, solitude, wait):
+        wait.return_value = {'status': constants.STATUS_PENDING,
+                             'uid_pay': 123}
+        self.start()
+        assert not solitude.generic.transaction.get_object.called
+
+    @raises(ValueError)
+    @mock.patch('webpay.pay.tasks.release_configure')
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('lib.marketplace.api.client.api')
+    def test_failure_releases_guard(self, marketplace, solitude, release):
+        solitude.generic.transaction.get_object.side_effect = ValueError
+        try:
+            self.start()
+        finally:
+            release.assert_called_with(self.transaction_uuid)
+
     @raises(ValueError)
     @mock.patch.object(settings, 'KEY', 'marketplace-domain')
     @mock.patch('lib.solitude.api.client.api')
@@ -620,9 +708,12 @@ class TestConfigureTrans(test.TestCase):
         for p in self.patches:
             p.stop()
 
-    def test_configure(self):
+    @mock.patch('webpay.pay.tasks.store_task_arg')
+    def test_configure(self, store):
+        store.return_value = 'ref'
         self.configure()
-        assert self.start_pay.delay.called
+        self.start_pay.delay.assert_called_with('trans-id', 'ref',
+                                                'some-email-token')
 
     def test_skip_when_fake(self):
         with self.settings(FAKE_PAYMENTS=True):
@@ -633,3 +724,18 @@ class TestConfigureTrans(test.TestCase):
         self.request.session['is_simulation'] = True
         self.configure()
         assert not self.start_pay.delay.called
+
+    def test_queued_once(self):
+        with local_cache('webpay.pay.utils.cache'):
+            self.configure()
+            self.configure()
+        eq_(self.start_pay.delay.call_count, 1)
+
+    def test_queued_again_when_enqueue_fails(self):
+        self.start_pay.delay.side_effect = IOError('broker is down')
+        with local_cache('webpay.pay.utils.cache'):
+            with self.assertRaises(IOError):
+                self.configure()
+            self.start_pay.delay.side_effect = None
+            self.configure()
+        eq_(self.start_pay.delay.call_count, 2)
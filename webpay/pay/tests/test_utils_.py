@@ -1,9 +1,17 @@
 from django import test
 from django.test.utils import override_settings
 
-from nose.tools import raises
+import mock
+from nose.tools import eq_, raises
 
-from webpay.pay.utils import verify_urls
+from lib.solitude import constants
+from webpay.base.tests import local_cache
+from webpay.pay.models import TaskArg
+from webpay.pay.utils import (cache_trans_status, claim_configure,
+                              forget_task_arg, HostHealth, load_task_arg,
+                              send_pay_notice, store_task_arg,
+                              take_configure_lease, TaskArgMissing,
+                              verify_urls)
 
 
 @override_settings(ALLOWED_CALLBACK_SCHEMES=['http', 'https'])
@@ -24,3 +32,155 @@ class TestVerifyURLs(test.TestCase):
     def test_https_only(self):
         with self.settings(ALLOWED_CALLBACK_SCHEMES=['https']):
             verify_urls('http://foo.com')
+
+
+class TestTaskArgs(test.TestCase):
+
+    def setUp(self):
+        p = local_cache('webpay.pay.utils.cache')
+        self.cache = p.start()
+        self.addCleanup(p.stop)
+
+    def test_inline(self):
+        eq_(store_task_arg({'request': {'name': 'Virtual Sword'}}),
+            {'request': {'name': 'Virtual Sword'}})
+
+    @override_settings(TASK_ARG_INLINE_SIZE=10)
+    def test_store(self):
+        ref = store_task_arg({'request': {'name': 'Virtual Sword'}})
+        assert len(ref) < 64, ref
+        eq_(load_task_arg(ref), {'request': {'name': 'Virtual Sword'}})
+
+    @override_settings(TASK_ARG_INLINE_SIZE=10)
+    def test_evicted(self):
+        ref = store_task_arg({'request': {'name': 'Virtual Sword'}})
+        self.cache.clear()
+        eq_(load_task_arg(ref), {'request': {'name': 'Virtual Sword'}})
+
+    def test_not_a_reference(self):
+        eq_(load_task_arg({'request': {}}), {'request': {}})
+        eq_(load_task_arg('some-value'), 'some-value')
+
+    @raises(TaskArgMissing)
+    @override_settings(TASK_ARG_INLINE_SIZE=10)
+    def test_forget(self):
+        ref = store_task_arg({'request': {'name': 'Virtual Sword'}})
+        forget_task_arg(ref)
+        eq_(TaskArg.objects.count(), 0)
+        load_task_arg(ref)
+
+
+class TestClaim(test.TestCase):
+
+    def test_claimed_once(self):
+        with local_cache('webpay.pay.utils.cache'):
+            assert claim_configure('trans')
+            assert not claim_configure('trans')
+            assert take_configure_lease('trans')
+            assert not take_configure_lease('trans')
+
+    @mock.patch('webpay.pay.utils.cache')
+    def test_cache_down(self, cache):
+        # Memcached backends answer like this when the server is down.
+        cache.add.return_value = False
+        cache.get.return_value = None
+        assert claim_configure('trans')
+        assert take_configure_lease('trans')
+
+    @mock.patch('webpay.pay.utils.cache')
+    def test_cache_error(self, cache):
+        cache.add.side_effect = IOError
+        assert claim_configure('trans')
+
+
+class TestTransStatus(test.TestCase):
+
+    @override_settings(TRANS_STATUS_TIMEOUT=100,
+                       TRANS_STATUS_PENDING_TIMEOUT=5)
+    @mock.patch('webpay.pay.utils.cache')
+    def test_pending_kept_briefly(self, cache):
+        cache_trans_status('some:trans', constants.STATUS_PENDING, 1)
+        eq_(cache.set.call_args[0][2], 5)
+        cache_trans_status('some:trans', constants.STATUS_COMPLETED, 1)
+        eq_(cache.set.call_args[0][2], 100)
+
+
+@override_settings(NOTICE_HOST_FAILURES=2, POSTBACK_CIRCUIT_BUDGET=2,
+                   POSTBACK_DELAY=10, POSTBACK_MAX_DELAY=100)
+class TestHostHealth(test.TestCase):
+
+    def setUp(self):
+        p = local_cache('webpay.pay.utils.cache')
+        p.start()
+        self.addCleanup(p.stop)
+        self.health = HostHealth('app.com')
+
+    def fail(self, times=2):
+        for i in range(times):
+            self.health.record(False)
+
+    def test_healthy(self):
+        self.fail(1)
+        assert self.health.allow()
+
+    def test_open(self):
+        self.fail()
+        assert not self.health.allow()
+        assert 10 <= self.health.retry_delay(1) <= 15 * 1.5
+
+    @mock.patch('webpay.pay.utils.time')
+    def test_half_open(self, time):
+        time.time.return_value = 0
+        self.fail()
+        time.time.return_value = 20
+        assert self.health.allow(), 'probe should be allowed'
+        assert not self.health.allow(), 'only one probe is allowed'
+        self.health.record(True)
+        assert self.health.allow()
+
+    def test_backoff(self):
+        assert 20 <= self.health.backoff(2) <= 30
+        assert 100 <= self.health.backoff(10) <= 150
+
+
+class TestHeldNotice(test.TestCase):
+
+    @mock.patch('webpay.pay.utils.post_notice')
+    @mock.patch('webpay.pay.utils.HostHealth.allow')
+    def test_held(self, allow, post_notice):
+        allow.return_value = False
+        task = mock.Mock()
+        task.request.kwargs = {'reason': 'refund'}
+        send_pay_notice('http://app.com/post', 1, 'signed', 'some:uuid',
+                        task, ['some:uuid'])
+        assert not post_notice.called
+        eq_(task.retry.call_args[1]['kwargs'],
+            {'reason': 'refund', 'attempts': 0, 'held': 1})
+
+    @override_settings(POSTBACK_CIRCUIT_BUDGET=2)
+    @mock.patch('webpay.pay.utils.notify_failure')
+    @mock.patch('webpay.pay.utils.post_notice')
+    @mock.patch('webpay.pay.utils.HostHealth.allow')
+    def test_held_too_often(self, allow, post_notice, notify_failure):
+        allow.return_value = False
+        task = mock.Mock()
+        task.request.kwargs = {'attempts': 0, 'held': 1}
+        send_pay_notice('http://app.com/post', 1, 'signed', 'some:uuid',
+                        task, ['some:uuid'])
+        assert not task.retry.called
+        assert notify_failure.called
+
+    @mock.patch('webpay.pay.utils.post_notice')
+    def test_budget_per_notice(self, post_notice):
+        post_notice.return_value = False, 'Timeout: ', IOError()
+        task = mock.Mock()
+        task.request.kwargs = {}
+        with local_cache('webpay.pay.utils.cache') as cache:
+            # The host's circuit has opened many times before.
+            cache.set(HostHealth('app.com').key,
+                      {'failures': 0, 'opened': 10, 'open_until': 0})
+            send_pay_notice('http://app.com/post', 1, 'signed',
+                            'some:uuid', task, ['some:uuid'])
+        # This notice still gets its own tries.
+        assert post_notice.called
+        assert task.retry.called
@@ -0,0 +1,59 @@
+import base64
+import calendar
+import time
+
+from django.conf import settings
+
+import jwt
+from mozpay.exc import InvalidJWT, RequestExpired
+from nose.tools import eq_, raises
+
+from webpay.pay.samples import JWTtester
+from webpay.pay.verify import ParsedJWT
+
+
+class TestParsedJWT(JWTtester):
+
+    def check(self, raw, secret=None):
+        return ParsedJWT(raw).verify(secret or self.secret, settings.DOMAIN,
+                                     required_keys=('request.pricePoint',))
+
+    def test_valid(self):
+        payload = self.payload()
+        eq_(self.check(self.request(payload=payload)), payload)
+
+    def test_parsed_once(self):
+        parsed = ParsedJWT(self.request())
+        eq_(parsed.issuer, self.key)
+        eq_(parsed.header['alg'], 'HS256')
+
+    @raises(jwt.DecodeError)
+    def test_broken(self):
+        ParsedJWT('foo')
+
+    @raises(InvalidJWT)
+    def test_bad_signature(self):
+        self.check(self.request(), secret=self.secret + '.nope')
+
+    @raises(InvalidJWT)
+    def test_unknown_algorithm(self):
+        raw = self.request().split('.')
+        raw[0] = base64.urlsafe_b64encode('{"typ": "JWT", "alg": "none"}')
+        self.check('.'.join(raw))
+
+    @raises(InvalidJWT)
+    def test_missing_issuer(self):
+        payload = self.payload()
+        del payload['iss']
+        self.check(self.request(payload=payload))
+
+    @raises(RequestExpired)
+    def test_expired(self):
+        iat = calendar.timegm(time.gmtime()) - 7200
+        self.check(self.request(iat=iat, exp=iat + 60))
+
+    @raises(InvalidJWT)
+    def test_missing_key(self):
+        payload = self.payload()
+        del payload['request']['pricePoint']
+        self.check(self.request(payload=payload))
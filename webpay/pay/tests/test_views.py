@@ -12,9 +12,10 @@ from nose.tools import eq_
 from lib.marketplace.api import UnknownPricePoint
 from lib.solitude import constants
 
-from webpay.base.tests import BasicSessionCase
+from webpay.base.tests import BasicSessionCase, local_cache
 from webpay.pay import get_payment_url
 from webpay.pay.samples import JWTtester
+from webpay.pay.utils import publish_trans_ready
 
 from . import Base, sample
 
@@ -280,7 +281,8 @@ class TestVerify(Base):
     @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
     def test_incorrect_simulation(self, get_active_product):
         get_active_product.return_value = {'secret': self.secret,
-                                           'access': constants.ACCESS_SIMULATE}
+                                           'access': constants.ACCESS_SIMULATE,
+                                           'seller': '/generic/seller/1/'}
         # Make a regular request, not a simulation.
         payload = self.request(iss='third-party-app')
         eq_(self.get(payload).status_code, 400)
@@ -315,7 +317,7 @@ class TestVerify(Base):
         eq_(res.status_code, 400)
 
 
-@mock.patch('lib.solitude.api.client.get_transaction')
+@mock.patch('lib.solitude.api.client.get_transaction_status')
 class TestWaitToStart(Base):
 
     def setUp(self):
@@ -330,8 +332,8 @@ class TestWaitToStart(Base):
         self.session.save()
 
     @mock.patch.object(settings, 'BANGO_PAY_URL', 'http://bango/pay?bcid=%s')
-    def test_redirect_when_ready(self, get_transaction):
-        get_transaction.return_value = {
+    def test_redirect_when_ready(self, get_status):
+        get_status.return_value = {
             'status': constants.STATUS_PENDING,
             'uid_pay': 123,
         }
@@ -339,8 +341,8 @@ class TestWaitToStart(Base):
         eq_(res['Location'], settings.BANGO_PAY_URL % 123)
 
     @mock.patch.object(settings, 'BANGO_PAY_URL', 'http://bango/pay?bcid=%s')
-    def test_start_ready(self, get_transaction):
-        get_transaction.return_value = {
+    def test_start_ready(self, get_status):
+        get_status.return_value = {
             'status': constants.STATUS_PENDING,
             'uid_pay': 123,
         }
@@ -350,16 +352,39 @@ class TestWaitToStart(Base):
         eq_(data['url'], settings.BANGO_PAY_URL % 123)
         eq_(data['status'], constants.STATUS_PENDING)
 
-    def test_start_not_there(self, get_transaction):
-        get_transaction.side_effect = ValueError
+    @mock.patch.object(settings, 'BANGO_PAY_URL', 'http://bango/pay?bcid=%s')
+    def test_start_published(self, get_status):
+        with local_cache('webpay.pay.utils.cache'):
+            publish_trans_ready('some:trans', 123)
+            res = self.client.get(self.start)
+        eq_(res.status_code, 200, res.content)
+        data = json.loads(res.content)
+        eq_(data['url'], settings.BANGO_PAY_URL % 123)
+        eq_(data['status'], constants.STATUS_PENDING)
+        assert not get_status.called
+
+    @mock.patch.object(settings, 'BANGO_PAY_URL', 'http://bango/pay?bcid=%s')
+    def test_status_cached(self, get_status):
+        get_status.return_value = {
+            'status': constants.STATUS_PENDING,
+            'uid_pay': 123,
+        }
+        with local_cache('webpay.pay.utils.cache'):
+            self.client.get(self.wait)
+            res = self.client.get(self.start)
+        eq_(json.loads(res.content)['url'], settings.BANGO_PAY_URL % 123)
+        eq_(get_status.call_count, 1)
+
+    def test_start_not_there(self, get_status):
+        get_status.side_effect = ValueError
         res = self.client.get(self.start)
         eq_(res.status_code, 200, res.content)
         data = json.loads(res.content)
         eq_(data['url'], None)
         eq_(data['status'], None)
 
-    def test_start_not_ready(self, get_transaction):
-        get_transaction.return_value = {
+    def test_start_not_ready(self, get_status):
+        get_status.return_value = {
             'status': constants.STATUS_RECEIVED,
             'uid_pay': 123,
         }
@@ -369,9 +394,9 @@ class TestWaitToStart(Base):
         eq_(data['url'], None)
         eq_(data['status'], constants.STATUS_RECEIVED)
 
-    def wait_ended_transaction(self, get_transaction, status):
+    def wait_ended_transaction(self, get_status, status):
         with self.settings(VERBOSE_LOGGING=True):
-            get_transaction.return_value = {
+            get_status.return_value = {
                 'status': status,
                 'uid_pay': 123,
             }
@@ -380,11 +405,11 @@ class TestWaitToStart(Base):
                                 'Transaction has already ended.',
                                 status_code=400)
 
-    def test_wait_ended_transaction(self, get_transaction):
+    def test_wait_ended_transaction(self, get_status):
         for status in constants.STATUS_ENDED:
-            self.wait_ended_transaction(get_transaction, status)
+            self.wait_ended_transaction(get_status, status)
 
-    def test_wait(self, get_transaction):
+    def test_wait(self, get_status):
         res = self.client.get(self.wait)
         eq_(res.status_code, 200)
         self.assertContains(res, 'Waiting')
@@ -432,9 +457,11 @@ class TestSimulate(BasicSessionCase, JWTtester):
         eq_(res.context['simulate'],
             self.session['notes']['pay_request']['request']['simulate'])
 
+    @mock.patch('webpay.pay.views.store_task_arg')
     @mock.patch('webpay.pay.views.tasks.simulate_notify')
-    def test_simulate_postback(self, notify):
+    def test_simulate_postback(self, notify, store):
+        store.return_value = 'ref'
         res = self.client.post(self.simulate_url)
-        notify.delay.assert_called_with(self.issuer_key,
-                                        self.session['notes']['pay_request'])
+        store.assert_called_with(self.session['notes']['pay_request'])
+        notify.delay.assert_called_with(self.issuer_key, 'ref')
         self.assertTemplateUsed(res, 'pay/simulate_done.html')
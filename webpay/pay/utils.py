@@ -1,20 +1,29 @@
 from datetime import datetime, timedelta
 from urllib2 import HTTPError
 from urlparse import urlparse
+import json
 import logging
+import random
+import time
+import uuid
 
 from django.conf import settings
+from django.core.cache import cache
 
 from celery.exceptions import RetryTaskError
 from django_statsd.clients import statsd
-import requests
 from requests.exceptions import RequestException
 
 from lib.marketplace.api import client
+from lib.solitude import constants
+from lib.solitude.api import client as solitude
+from lib.utils import get_session
 
-from .models import NOT_SIMULATED
+from .models import NOT_SIMULATED, TaskArg
 
 log = logging.getLogger('w.pay.utils')
+# Postbacks to all app servers share one pool of keep-alive connections.
+http = get_session('postbacks')
 
 
 def format_exception(exception):
@@ -54,22 +63,38 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
         String to indicate the last exception message in the case of failure.
     """
     log.info('about to notify %s of notice type %s' % (url, notice_type))
-    exception = None
-    success = False
+    health = HostHealth(urlparse(url).netloc)
+    task_kwargs = dict(notifier_task.request.kwargs or {})
+    attempts = task_kwargs.get('attempts', 0)
+    # Times this notice was held back because its server was failing.
+    held = task_kwargs.get('held', 0)
 
-    try:
-        with statsd.timer('purchase.send_pay_notice'):
-            res = requests.post(url, {'notice': signed_notice}, timeout=5)
-        res.raise_for_status()  # raise exception for non-200s
-        res_content = res.text
-    except (HTTPError, RequestException), exception:
-        log.error('Notice for transaction %s raised exception in URL %s'
-                  % (trans_id, url), exc_info=True)
+    if health.allow():
+        success, last_error, exception = post_notice(url, signed_notice,
+                                                     trans_id)
+        health.record(exception is None)
+        attempts += 1
+    else:
+        # Don't wait on a server that is known to be down. This isn't
+        # counted as an attempt.
+        statsd.incr('purchase.send_pay_notice.held')
+        held += 1
+        exception = HostUnavailable('%s is not accepting notices'
+                                    % health.host)
+        success, last_error = False, format_exception(exception)
+
+    if exception:
         try:
-            notifier_task.retry(args=task_args,
+            if (attempts >= settings.POSTBACK_ATTEMPTS or
+                held >= settings.POSTBACK_CIRCUIT_BUDGET):
+                raise exception
+            task_kwargs['attempts'] = attempts
+            if held:
+                task_kwargs['held'] = held
+            notifier_task.retry(args=task_args, kwargs=task_kwargs,
                 eta=(datetime.now() +
-                     timedelta(seconds=settings.POSTBACK_DELAY)),
-                max_retries=settings.POSTBACK_ATTEMPTS,
+                     timedelta(seconds=health.retry_delay(attempts))),
+                max_retries=None,
                 exc=exception)
 
         # Retry actually raises an exception, so let that through.
@@ -87,6 +112,109 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
                          'for %r' % trans_id)
             return False, format_exception(final_exception)
 
+    return success, last_error
+
+
+class HostUnavailable(Exception):
+    """Notices to this app server are being held back."""
+
+
+def _jitter(seconds):
+    # Spread retries out so they don't all hit a server at once.
+    return seconds * random.uniform(1, 1.5)
+
+
+def backoff(count):
+    """
+    Returns seconds to wait before trying a notice again after count
+    tries, doubling from POSTBACK_DELAY up to POSTBACK_MAX_DELAY.
+    """
+    return _jitter(min(settings.POSTBACK_DELAY * 2 ** (count - 1),
+                       settings.POSTBACK_MAX_DELAY))
+
+
+class HostHealth(object):
+    """
+    Tracks whether an app server is accepting notices. The state is kept
+    in the cache so it is shared by every worker.
+
+    After NOTICE_HOST_FAILURES failures in a row the circuit opens and
+    notices for the server are held for an exponentially growing delay.
+    After that delay one notice is let through as a probe. If it works the
+    server is healthy again, otherwise the circuit opens for longer. Each
+    notice gives up once it has been held POSTBACK_CIRCUIT_BUDGET times.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.key = 'webpay:host-health:%s' % host
+        self.probe_key = self.key + ':probe'
+
+    def _state(self):
+        return (cache.get(self.key) or
+                {'failures': 0, 'opened': 0, 'open_until': 0})
+
+    def allow(self):
+        """Returns True if a notice can be sent to the server now."""
+        state = self._state()
+        if state['failures'] < settings.NOTICE_HOST_FAILURES:
+            return True
+        if time.time() < state['open_until']:
+            return False
+        # The circuit is half open, only one probe may go through.
+        return cache.add(self.probe_key, True, 60)
+
+    def record(self, ok):
+        """Records the result of sending a notice to the server."""
+        cache.delete(self.probe_key)
+        if ok:
+            cache.delete(self.key)
+            return
+        state = self._state()
+        state['failures'] += 1
+        now = time.time()
+        if (state['failures'] >= settings.NOTICE_HOST_FAILURES and
+            state['open_until'] <= now):
+            state['opened'] += 1
+            state['open_until'] = now + self.backoff(state['opened'])
+            statsd.incr('purchase.send_pay_notice.circuit_open')
+            log.warning('Holding notices to %s for %d seconds'
+                        % (self.host, state['open_until'] - now))
+        cache.set(self.key, state, settings.POSTBACK_MAX_DELAY * 2)
+
+    def backoff(self, count):
+        return backoff(count)
+
+    def retry_delay(self, attempts):
+        """
+        Returns seconds to wait before sending another notice after
+        attempts tries.
+        """
+        wait = self._state()['open_until'] - time.time()
+        if wait > 0:
+            return _jitter(wait)
+        return self.backoff(max(attempts, 1))
+
+
+def post_notice(url, signed_notice, trans_id):
+    """
+    Makes one attempt at posting a signed notice to an app.
+
+    A tuple of (success, last_error, exception) is returned. exception is
+    the error raised when the app could not be reached, if any, and
+    means the notice should be tried again later.
+    """
+    exception = None
+    success = False
+
+    try:
+        with statsd.timer('purchase.send_pay_notice'):
+            res = http.post(url, {'notice': signed_notice}, timeout=5)
+        res.raise_for_status()  # raise exception for non-200s
+        res_content = res.text
+    except (HTTPError, RequestException), exception:
+        log.error('Notice for transaction %s raised exception in URL %s'
+                  % (trans_id, url), exc_info=True)
     else:
         if res_content == str(trans_id):
             success = True
@@ -101,7 +229,7 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
     else:
         last_error = ''
 
-    return success, last_error
+    return success, last_error, exception
 
 
 def notify_failure(url, trans_id):
@@ -123,3 +251,176 @@ def verify_urls(*urls, **kw):
             parsed.scheme not in settings.ALLOWED_CALLBACK_SCHEMES):
             raise ValueError('Schema must be one of: %s not %s' %
                              (settings.ALLOWED_CALLBACK_SCHEMES, url))
+
+
+# References to task arguments held by store_task_arg() start with this.
+TASK_ARG_PREFIX = 'webpay:task-arg:'
+
+
+class TaskArgMissing(Exception):
+    """A stored task argument was removed before the task used it."""
+
+
+def store_task_arg(value):
+    """
+    Returns what to queue with a task in place of value, such as a pay
+    request.
+
+    Values up to TASK_ARG_INLINE_SIZE bytes of JSON are queued as they
+    are. Larger ones are stored in the cache and the database, and a
+    short reference is returned instead. Workers get the value back
+    with load_task_arg().
+    """
+    data = json.dumps(value)
+    if len(data) <= settings.TASK_ARG_INLINE_SIZE:
+        return value
+    ref = TASK_ARG_PREFIX + uuid.uuid4().hex
+    TaskArg.objects.create(key=ref, value=data)
+    cache.set(ref, value, settings.TASK_ARG_TIMEOUT)
+    return ref
+
+
+def load_task_arg(arg):
+    """
+    Returns the value stored for a reference from store_task_arg().
+
+    Any other argument, such as one queued before references were used,
+    is returned as it is.
+    """
+    if not (isinstance(arg, basestring) and
+            arg.startswith(TASK_ARG_PREFIX)):
+        return arg
+    value = cache.get(arg)
+    if value is None:
+        # The cache might have evicted it.
+        try:
+            value = json.loads(TaskArg.objects.get(key=arg).value)
+        except TaskArg.DoesNotExist:
+            raise TaskArgMissing('Task argument %s was removed' % arg)
+    return value
+
+
+def forget_task_arg(arg):
+    """Removes a stored argument once its task no longer needs it."""
+    if isinstance(arg, basestring) and arg.startswith(TASK_ARG_PREFIX):
+        cache.delete(arg)
+        TaskArg.objects.filter(key=arg).delete()
+
+
+def cache_claim(key, timeout):
+    """
+    Adds key to the cache and returns True unless it is already there.
+
+    Claims only save duplicate work so they fail open: when the cache
+    can't be reached, the caller goes ahead.
+    """
+    try:
+        if cache.add(key, True, timeout):
+            return True
+        # Memcached backends return False when the server is down too, so
+        # only a key that can be read back is a real claim.
+        return cache.get(key) is None
+    except Exception:
+        log.exception('Could not claim %s, going ahead anyway' % key)
+        return True
+
+
+def configure_key(trans_id):
+    return 'webpay:configure:%s' % trans_id
+
+
+def claim_configure(trans_id):
+    """
+    Returns True if the caller may queue a start_pay job for the
+    transaction, False if one has already been queued.
+    """
+    return cache_claim(configure_key(trans_id),
+                       settings.CONFIGURE_ENQUEUE_TIMEOUT)
+
+
+def release_configure(trans_id):
+    """Lets start_pay be queued again, such as after it failed."""
+    cache.delete(configure_key(trans_id))
+
+
+def configure_lease_key(trans_id):
+    return 'webpay:configure-lease:%s' % trans_id
+
+
+def take_configure_lease(trans_id):
+    """
+    Returns True if the caller may configure the transaction, False if
+    another start_pay job is already doing it.
+    """
+    return cache_claim(configure_lease_key(trans_id),
+                       settings.CONFIGURE_LEASE_TIMEOUT)
+
+
+def end_configure_lease(trans_id):
+    cache.delete(configure_lease_key(trans_id))
+
+
+def trans_status_key(trans_id):
+    return 'webpay:trans-status:%s' % trans_id
+
+
+def cache_trans_status(trans_id, status, uid_pay):
+    # A pending transaction can be completed without anyone here being
+    # told, so that status is only kept briefly.
+    if status == constants.STATUS_PENDING:
+        timeout = settings.TRANS_STATUS_PENDING_TIMEOUT
+    else:
+        timeout = settings.TRANS_STATUS_TIMEOUT
+    cache.set(trans_status_key(trans_id),
+              {'status': status, 'uid_pay': uid_pay}, timeout)
+
+
+def forget_trans_status(trans_id):
+    cache.delete(trans_status_key(trans_id))
+
+
+def publish_trans_ready(trans_id, uid_pay):
+    """
+    Tells anyone waiting on the transaction that it can be paid for.
+    """
+    cache_trans_status(trans_id, constants.STATUS_PENDING, uid_pay)
+
+
+def wait_for_trans(trans_id, timeout):
+    """
+    Waits up to timeout seconds for the transaction's status to be cached,
+    such as by publish_trans_ready().
+
+    Returns a dict of status and uid_pay or None if nothing was cached.
+    This only checks the cache so waiting never touches Solitude.
+    """
+    key = trans_status_key(trans_id)
+    deadline = time.time() + timeout
+    while True:
+        trans = cache.get(key)
+        if trans is not None or time.time() >= deadline:
+            return trans
+        time.sleep(settings.TRANS_STATUS_POLL_INTERVAL)
+
+
+def get_trans_status(trans_id, wait=0):
+    """
+    Returns a dict of status and uid_pay for the transaction.
+
+    The cache is checked first, waiting up to wait seconds, and Solitude
+    is only asked if nothing was found. The status is None when Solitude
+    doesn't know about the transaction yet.
+    """
+    trans = wait_for_trans(trans_id, wait)
+    if trans is not None:
+        return trans
+    try:
+        trans = solitude.get_transaction_status(trans_id)
+    except ValueError:
+        return {'status': None, 'uid_pay': None}
+    if (trans['status'] == constants.STATUS_PENDING or
+        trans['status'] in constants.STATUS_ENDED):
+        # The transaction won't change from here until the buyer pays,
+        # or ever, so polls don't need to ask Solitude again for a while.
+        cache_trans_status(trans_id, trans['status'], trans['uid_pay'])
+    return trans
@@ -0,0 +1,97 @@
+"""
+Decodes and verifies pay request JWTs in a single pass.
+
+mozpay.verify.verify_jwt() decodes the JWT three times, on top of the
+decode VerifyForm needs to find the issuer. A ParsedJWT is decoded once
+by the form and then verified by the view with the issuer's secret.
+"""
+import base64
+import hashlib
+import hmac
+import json
+
+from jwt import DecodeError
+from mozpay.exc import InvalidJWT
+from mozpay.verify import verify_audience, verify_claims, verify_keys
+
+ALGORITHMS = {
+    'HS256': hashlib.sha256,
+    'HS384': hashlib.sha384,
+    'HS512': hashlib.sha512,
+}
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def _equal(a, b):
+    # Compare every byte so the time taken doesn't leak the signature.
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class ParsedJWT(object):
+    """
+    A JWT split into its header, payload and signature.
+
+    :param raw: the JWT string.
+
+    Raises jwt.DecodeError if the JWT can't be decoded. Nothing is
+    trusted until verify() has been called.
+    """
+
+    def __init__(self, raw):
+        try:
+            raw = str(raw)
+        except UnicodeEncodeError:
+            raise DecodeError('Non-ascii JWT')
+        try:
+            self.signing_input, crypto_segment = raw.rsplit('.', 1)
+            header_segment, payload_segment = self.signing_input.split('.', 1)
+        except ValueError:
+            raise DecodeError('Not enough segments')
+        try:
+            self.header = json.loads(_b64decode(header_segment))
+            self.payload = json.loads(_b64decode(payload_segment))
+            self.signature = _b64decode(crypto_segment)
+        except (ValueError, TypeError):
+            raise DecodeError('Invalid segment encoding')
+
+    @property
+    def issuer(self):
+        if isinstance(self.payload, dict):
+            return self.payload.get('iss')
+
+    def verify(self, secret, audience, required_keys=()):
+        """
+        Checks the signature, claims, audience and required keys.
+
+        Returns the trusted payload or raises mozpay.exc.InvalidJWT, just
+        like mozpay.verify.verify_jwt().
+        """
+        issuer = self.issuer
+        if not issuer:
+            raise InvalidJWT('Payment JWT is missing iss (issuer)')
+        self.verify_sig(secret, issuer)
+        verify_claims(self.payload, issuer=issuer)
+        verify_audience(self.payload, audience, issuer=issuer)
+        verify_keys(self.payload, required_keys, issuer=issuer)
+        return self.payload
+
+    def verify_sig(self, secret, issuer=None):
+        try:
+            digest = ALGORITHMS[self.header['alg']]
+        except (KeyError, TypeError):
+            raise InvalidJWT('Signature verification failed: '
+                             'Algorithm not supported', issuer=issuer)
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        expected = hmac.new(secret, self.signing_input, digest).digest()
+        if not _equal(expected, self.signature):
+            raise InvalidJWT('Signature verification failed',
+                             issuer=issuer)
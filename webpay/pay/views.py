@@ -7,7 +7,6 @@ from django.shortcuts import render
 from django.views.decorators.http import require_GET, require_POST
 
 from mozpay.exc import InvalidJWT, RequestExpired
-from mozpay.verify import verify_jwt
 from session_csrf import anonymous_csrf_exempt
 from tower import ugettext as _
 
@@ -26,7 +25,7 @@ from lib.solitude.api import client as solitude
 
 from . import tasks
 from .forms import VerifyForm
-from .utils import verify_urls
+from .utils import get_trans_status, store_task_arg, verify_urls
 
 log = getLogger('w.pay')
 
@@ -45,10 +44,10 @@ def process_pay_req(request):
                       status=503)
 
     try:
-        pay_req = verify_jwt(
-            form.cleaned_data['req'],
-            settings.DOMAIN,  # JWT audience.
+        # The form already decoded the JWT, this only checks it.
+        pay_req = form.jwt.verify(
             form.secret,
+            settings.DOMAIN,  # JWT audience.
             required_keys=('request.id',
                            'request.pricePoint',  # A price tier we'll lookup.
                            'request.name',
@@ -56,7 +55,7 @@ def process_pay_req(request):
                            'request.postbackURL',
                            'request.chargebackURL'))
     except (TypeError, InvalidJWT, RequestExpired), exc:
-        log.exception('calling verify_jwt')
+        log.exception('verifying JWT')
         return _error(request, exception=exc,
                       display=form.is_simulation)
 
@@ -148,8 +147,9 @@ def simulate(request):
     if not request.session.get('is_simulation', False):
         log.info('Request to simulate without a valid session')
         return http.HttpResponseForbidden()
-    tasks.simulate_notify.delay(request.session['notes']['issuer_key'],
-                                request.session['notes']['pay_request'])
+    tasks.simulate_notify.delay(
+        request.session['notes']['issuer_key'],
+        store_task_arg(request.session['notes']['pay_request']))
     return render(request, 'pay/simulate_done.html', {})
 
 
@@ -181,10 +181,7 @@ def wait_to_start(request):
     When ready, redirect to the Bango payment URL using
     the generated billing configuration ID.
     """
-    try:
-        trans = solitude.get_transaction(request.session['trans_id'])
-    except ValueError:
-        trans = {'status': None}
+    trans = get_trans_status(request.session['trans_id'])
 
     if trans['status'] in constants.STATUS_ENDED:
         log.exception('Attempt to restart finished transaction.')
@@ -202,11 +199,13 @@ def wait_to_start(request):
 def trans_start_url(request):
     """
     JSON handler to get the Bango payment URL to start a transaction.
+
+    This waits up to TRANS_START_WAIT seconds, briefly by default, for
+    start_pay to publish the transaction as ready before asking Solitude.
+    The page keeps polling until there is a URL.
     """
-    try:
-        trans = solitude.get_transaction(request.session['trans_id'])
-    except ValueError:
-        trans = {'status': None}
+    trans = get_trans_status(request.session['trans_id'],
+                             wait=settings.TRANS_START_WAIT)
     data = {'url': None, 'status': trans['status']}
     if trans['status'] == constants.STATUS_PENDING:
         data['url'] = _bango_start_url(trans['uid_pay'])
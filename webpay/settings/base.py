@@ -169,15 +169,22 @@ LOGGING = {
             'handlers': ['console', 'unicodesyslog', 'sentry'],
         },
     },
+    # These write from a thread so logging never waits on syslog or Sentry.
     'handlers': {
         'unicodesyslog': {
-            'class': 'webpay.unicode_log.UnicodeHandler',
-            'facility': logging.handlers.SysLogHandler.LOG_LOCAL7,
+            'class': 'webpay.base.logger.QueueHandler',
+            'handler': {
+                'class': 'webpay.unicode_log.UnicodeHandler',
+                'facility': logging.handlers.SysLogHandler.LOG_LOCAL7,
+            },
             'formatter': 'prod',
         },
         'sentry': {
             'level': 'ERROR',
-            'class': 'raven.contrib.django.handlers.SentryHandler',
+            'class': 'webpay.base.logger.QueueHandler',
+            'handler': {
+                'class': 'raven.contrib.django.handlers.SentryHandler',
+            },
         },
     },
 }
@@ -186,6 +193,7 @@ LOGGING = {
 MIDDLEWARE_CLASSES = (
     'django_statsd.middleware.GraphiteRequestTimingMiddleware',
     'django_statsd.middleware.GraphiteMiddleware',
+    'webpay.base.middleware.CallsMiddleware',
     'webpay.base.middleware.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -198,8 +206,24 @@ MIDDLEWARE_CLASSES = (
     'django_paranoia.middleware.Middleware',
     'django_paranoia.sessions.ParanoidSessionMiddleware',
     'webpay.base.logger.LoggerMiddleware',
+    'webpay.auth.middleware.BuyerCacheMiddleware',
 )
 
+# Send the Solitude, Marketplace, Persona and database calls made for each
+# request in a Server-Timing header. CallsMiddleware always logs them.
+SERVER_TIMING = False
+
+# Most CEF records waiting to be written by the background writer. Any
+# more are dropped and counted in statsd as cef.dropped.
+CEF_QUEUE_SIZE = 10000
+
+# Most CEF records written at a time.
+CEF_BATCH_SIZE = 100
+
+# Accept-Language headers and lang parameters whose locale is remembered
+# by each process.
+LOCALE_CACHE_SIZE = 500
+
 STATSD_CLIENT = 'django_statsd.clients.normal'
 
 DJANGO_PARANOIA_REPORTERS = [
@@ -217,6 +241,29 @@ SESSION_COOKIE_NAME = 'webpay_sessionid'
 # If you need to disable it, make this True in your local settings.
 CELERY_ALWAYS_EAGER = False  # required to activate celeryd
 
+# start_pay is on the buyer's critical path so it has a queue of its own
+# where it never waits behind notices, which can be retried for hours.
+# Run separate workers for each queue, for example:
+#
+#   ./manage.py celeryd -Q webpay.configure --concurrency=8
+#   ./manage.py celeryd -Q webpay.notices,celery --concurrency=4
+#
+CELERY_ROUTES = {
+    'webpay.pay.tasks.start_pay': {'queue': 'webpay.configure'},
+    'webpay.pay.tasks.payment_notify': {'queue': 'webpay.notices'},
+    'webpay.pay.tasks.chargeback_notify': {'queue': 'webpay.notices'},
+    'webpay.pay.tasks.simulate_notify': {'queue': 'webpay.notices'},
+    'webpay.bango.tasks.forward_events': {'queue': 'webpay.notices'},
+}
+
+# Workers only reserve the task they are about to run so that a slow
+# notice can't hold up tasks another worker could be running.
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+# Seconds to remember when a task was queued so its time waiting in the
+# queue can be sent to statsd.
+CELERY_LAG_TIMEOUT = 60 * 60
+
 # This is the key and secret for purchases, our special marketplace key and
 # secret for selling apps.
 KEY = 'marketplace'  # would typically be a URL
@@ -296,12 +343,168 @@ ALLOWED_CALLBACK_SCHEMES = ['http', 'https']
 # When we are ready to having curling format lists for us, flip this to True.
 CURLING_FORMAT_LISTS = False
 
+# Keep-alive connection pools for outgoing HTTP requests. Solitude and
+# Marketplace pools are named after their host, such as
+# 'solitude.example.com:443'; app postbacks use the 'postbacks' pool.
+# Anything not set for a pool comes from 'default'.
+HTTP_POOLS = {
+    'default': {
+        # Number of hosts to keep connections open to.
+        'pool_connections': 10,
+        # Number of idle connections to keep open to each host.
+        'pool_maxsize': 10,
+        'keep_alive': True,
+        # Seconds to wait for a connection or a response.
+        'timeout': 10,
+    },
+    'postbacks': {
+        'pool_connections': 100,
+        # This should match NOTICE_HOST_CONCURRENCY.
+        'pool_maxsize': 2,
+        'timeout': 5,
+    },
+}
+
+# Number of threads in each process for running independent Solitude and
+# Marketplace calls at the same time.
+PARALLEL_WORKERS = 10
+
+# Number of threads for calls made from those threads, such as creating a
+# Bango product while start_pay looks up the seller. Calls made from these
+# threads run in the calling thread. 0 runs every nested call that way.
+PARALLEL_NESTED_WORKERS = 10
+
+# Seconds to wait for a call running in one of those threads.
+PARALLEL_TIMEOUT = 30
+
+# Seconds to cache the secret, access and seller of a JWT issuer. Run
+# `manage.py forget_issuer <key>` after an issuer's secret changes.
+ISSUER_CACHE_TIMEOUT = 60 * 60
+
+# Seconds to remember that a JWT issuer doesn't exist or isn't active.
+ISSUER_CACHE_UNKNOWN_TIMEOUT = 60
+
+# Number of unknown JWT issuers each process remembers.
+ISSUER_UNKNOWN_LOCAL_SIZE = 1000
+
+# Seconds between reloads of the filter of every active JWT issuer, which
+# turns away unknown issuers without looking them up. New issuers can be
+# turned away for up to twice this long unless `manage.py forget_issuer
+# <key>` is run for them. 0 turns the filter off.
+ISSUER_FILTER_REFRESH = 60 * 5
+
+# Chance of the filter letting an unknown issuer through to be looked up.
+ISSUER_FILTER_ERROR_RATE = 0.01
+
+# Seconds to cache sellers, including their bango account.
+SELLER_CACHE_TIMEOUT = 60 * 10
+
+# When True, Bango Event Notifications are saved and Bango gets an OK
+# straight away. They are forwarded to Solitude in the background by the
+# forward_events task and the forward_bango_events command, which should
+# be run from cron.
+BANGO_EVENT_QUEUE = False
+
+# The Basic auth credentials Bango sends with event notifications, which
+# must match those Solitude has. With BANGO_EVENT_QUEUE on they are
+# checked when the event is received and used again when forwarding it.
+BANGO_EVENT_USERNAME = ''
+BANGO_EVENT_PASSWORD = ''
+
+# Bango events forwarded to Solitude at the same time.
+BANGO_EVENT_BATCH = 20
+
+# Seconds a claimed Bango event is held for before it can be claimed
+# again, in case whatever claimed it died.
+BANGO_EVENT_CLAIM_TIMEOUT = 60 * 5
+
+# Tries at forwarding a Bango event before giving up on it.
+BANGO_EVENT_ATTEMPTS = 10
+
+# Seconds before forwarding a Bango event again, doubling after each
+# failure up to BANGO_EVENT_MAX_DELAY.
+BANGO_EVENT_DELAY = 60
+BANGO_EVENT_MAX_DELAY = 60 * 60
+
+# Seconds to cache the URI of a seller's bango product.
+BANGO_PRODUCT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Most seconds to wait for another process to create a bango product
+# before looking it up or creating it anyway.
+BANGO_PRODUCT_LOCK_TIMEOUT = 30
+
+# When True, payment and chargeback notices are written to an outbox
+# table before being sent and retries are sent from there by the
+# deliver_notices command instead of waiting in the broker. Only turn
+# this on where that command is run from cron.
+NOTICE_OUTBOX = False
+
+# Most notices deliver_notices claims from the outbox at a time.
+NOTICE_OUTBOX_BATCH = 500
+
+# Seconds a claimed outbox notice is held for before another dispatcher
+# may claim it, in case the one that claimed it died.
+NOTICE_OUTBOX_CLAIM_TIMEOUT = 60 * 5
+
+# Task arguments, such as pay requests, up to this many bytes of JSON are
+# queued with the task. Larger ones are queued by reference.
+TASK_ARG_INLINE_SIZE = 1024 * 8
+
+# Seconds to keep task arguments that are queued by reference. This must
+# outlast every retry of a notice. The clean_task_args command removes
+# older ones from the database.
+TASK_ARG_TIMEOUT = 60 * 60 * 24 * 3
+
+# Seconds to stop more start_pay jobs being queued for a transaction
+# once one has been queued.
+CONFIGURE_ENQUEUE_TIMEOUT = 60 * 5
+
+# Seconds a start_pay job can hold a transaction for before another job
+# may configure it.
+CONFIGURE_LEASE_TIMEOUT = 60 * 2
+
+# Seconds that trans_start_url holds a request open waiting for the
+# transaction to be ready before checking Solitude and responding. Each
+# waiting buyer ties up a whole sync worker, so keep this short and let
+# the page poll again; only raise it when serving from async workers.
+TRANS_START_WAIT = 1
+
+# Seconds between checks of the cache while waiting.
+TRANS_STATUS_POLL_INTERVAL = 0.25
+
+# Seconds to keep a transaction's status in the cache for polls once it
+# has ended.
+TRANS_STATUS_TIMEOUT = 60 * 60
+
+# Seconds to keep a pending status in the cache. The transaction can end
+# without this process hearing about it, so keep this short.
+TRANS_STATUS_PENDING_TIMEOUT = 10
+
 # Number of retries on a payment postback.
 POSTBACK_ATTEMPTS = 5
 
-# Amount of seconds between each payment postback attempt.
+# Amount of seconds between each payment postback attempt. This doubles
+# with each attempt.
 POSTBACK_DELAY = 300
 
+# Number of threads in each process for delivering batches of notices.
+NOTICE_WORKERS = 20
+
+# Number of notices to post to the same app server at the same time.
+NOTICE_HOST_CONCURRENCY = 2
+
+# Failures in a row after which notices to an app server are held back
+# instead of being sent. See webpay.pay.utils.HostHealth.
+NOTICE_HOST_FAILURES = 3
+
+# Number of times a notice to a failing app server is held back before
+# giving up on it. The server's circuit stays open for twice as long each
+# time, starting at POSTBACK_DELAY.
+POSTBACK_CIRCUIT_BUDGET = 5
+
+# Most seconds to wait between postback attempts.
+POSTBACK_MAX_DELAY = 60 * 60 * 6
+
 # When True, developers can simulate payments by signing a JWT with a simulate
 # attribute in the request.
 ALLOW_SIMULATE = True
@@ -327,3 +530,20 @@ USER_WHITELIST = []
 # Secret key string to use in UUID HMACs which are derived from Persona emails.
 # This must not be blank in production and should be more than 32 bytes long.
 UUID_HMAC_KEY = ''
+
+# Seconds before the Marketplace price tier table is refreshed. Set this to
+# 0 to look up every price point from the Marketplace API.
+PRICE_CACHE_TIMEOUT = 60 * 60
+
+# Seconds that an old price tier table may still be used when the
+# Marketplace API can't be reached.
+PRICE_CACHE_STALE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Seconds that one process may spend loading the price tier table before
+# another one can try. Others wait that long at most before loading it
+# themselves.
+PRICE_CACHE_LOCK_TIMEOUT = 60
+
+# Process-local price tier cache size and timeout in seconds.
+PRICE_CACHE_LOCAL_SIZE = 100
+PRICE_CACHE_LOCAL_TIMEOUT = 60